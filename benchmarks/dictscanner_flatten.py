@@ -0,0 +1,69 @@
+"""Throughput of DictScanner on deep and wide records
+
+Usage (from the repository root): python -m benchmarks.dictscanner_flatten [--records N]
+
+Scans records of a few shapes: flat, a list of many child objects, and
+objects nested deeper than the default recursion limit allows for a
+recursive walk.
+"""
+
+import argparse
+import sys
+import time
+
+from bobtools.datascan import DictScanner
+
+
+def flat_record(i):
+    return {f"field_{j}": i * j for j in range(20)}
+
+
+def wide_record(i):
+    return {"id": i, "children": [{"n": j, "name": f"child {j}"} for j in range(1000)]}
+
+
+def deep_record(i, depth=50):
+    record = {"value": i}
+    for level in range(depth):
+        record = {"level": level, "child": record}
+    return record
+
+
+def very_deep_record(i):
+    return deep_record(i, depth=sys.getrecursionlimit() + 100)
+
+
+SHAPES = {
+    "flat": (flat_record, 1),
+    "wide": (wide_record, 0.01),
+    "deep": (deep_record, 0.1),
+    "very deep": (very_deep_record, 0.01),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f"{'shape':<10} {'records':>8} {'values/s':>12} {'records/s':>10}")
+    for name, (make_record, share) in SHAPES.items():
+        n_records = max(1, int(args.records * share))
+        records = [make_record(i) for i in range(n_records)]
+        scanner = DictScanner()
+        start = time.perf_counter()
+        try:
+            scanner.scan_all(records)
+        except RecursionError:
+            print(f"{name:<10} {n_records:>8} {'RecursionError':>23}")
+            continue
+        elapsed = time.perf_counter() - start
+        n_values = sum(leaf["count"] for leaf in scanner.root.values())
+        print(
+            f"{name:<10} {n_records:>8} {n_values / elapsed:>12,.0f} "
+            f"{n_records / elapsed:>10,.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""CPU time used by the parent process while funnel waits for its workers
+
+Usage (from the repository root):
+    python -m benchmarks.funnel_parent_cpu [--tasks N] [--duration S] [--workers N]
+
+The workers sleep instead of computing, so nearly all CPU time the parent uses
+is overhead of submitting tasks and collecting results.
+"""
+
+import argparse
+import time
+
+from bobtools.parallel import funnel
+
+
+def slow_task(x, duration):
+    time.sleep(duration)
+    return x
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tasks", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, default=5)
+    args = parser.parse_args()
+
+    tasks = ((i, args.duration) for i in range(args.tasks))
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    n_results = sum(1 for _ in funnel(tasks, slow_task, n_workers=args.workers))
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+
+    print(f"results     : {n_results}/{args.tasks}")
+    print(f"wall time   : {wall:.2f}s")
+    print(f"parent CPU  : {cpu:.2f}s ({100 * cpu / wall:.0f}% of a core)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Moving large NumPy arrays through funnel, with and without shared memory
+
+Usage (from the repository root):
+    python -m benchmarks.funnel_shared_memory [--tasks N] [--size MB] [--workers N]
+
+Every task returns an array of `size` MB, which the single_func reduces to its
+sum, so the results cross two process boundaries.
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from bobtools.parallel import Funnel
+
+
+def make_array(i, n_items):
+    return np.full(n_items, i, dtype="float64")
+
+
+def total(array):
+    return float(array.sum())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tasks", type=int, default=200)
+    parser.add_argument("--size", type=float, default=8)
+    parser.add_argument("--workers", type=int, default=3)
+    args = parser.parse_args()
+    n_items = int(args.size * 1024 * 1024 / 8)
+
+    for shared_memory in [False, True]:
+        with Funnel(
+            n_workers=args.workers,
+            shared_memory=shared_memory,
+            shm_block_size=n_items * 8,
+        ) as pool:
+            tasks = ((i, n_items) for i in range(args.tasks))
+            start = time.perf_counter()
+            n_results = sum(1 for _ in pool.run(tasks, make_array, total))
+            wall = time.perf_counter() - start
+        print(
+            f"shared_memory={shared_memory!s:<5} : {n_results} results of "
+            f"{args.size:g}MB in {wall:.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Throughput of the JSON backends available to JSONL
+
+Usage (from the repository root): python -m benchmarks.jsonl_backends [--records N]
+
+Measures raw dumps/loads throughput per backend on a few representative record
+shapes, and end-to-end JSONL.extend / JSONL.stream on plain and gzipped files.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from bobtools.io import JSONL, backends
+
+
+def flat_record(i):
+    return {"id": i, "name": f"user {i}", "score": i * 0.5, "active": i % 2 == 0}
+
+
+def nested_record(i):
+    return {
+        "url": f"https://example.com/page/{i}",
+        "status": 200,
+        "meta": {"title": f"Page {i}", "lang": "en", "tags": ["a", "b", "c"]},
+        "links": [{"href": f"/page/{j}", "text": f"link {j}"} for j in range(10)],
+        "body": "lorem ipsum dolor sit amet " * 20,
+    }
+
+
+def wide_record(i):
+    return {f"field_{j}": i * j for j in range(100)}
+
+
+SHAPES = {"flat": flat_record, "nested": nested_record, "wide": wide_record}
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def bench_backend(backend, records):
+    lines = [backend.dumps(record).encode() for record in records]
+
+    def dumps():
+        for record in records:
+            backend.dumps(record)
+
+    def loads():
+        for line in lines:
+            backend.loads(line)
+
+    return len(records) / timed(dumps), len(records) / timed(loads)
+
+
+def bench_jsonl(backend, records, extension):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, f"bench.{extension}")
+        jsonl = JSONL(filename, json_backend=backend.name)
+        write = timed(lambda: (jsonl.extend(records), jsonl.close()))
+        jsonl = JSONL(filename, json_backend=backend.name)
+        read = timed(lambda: sum(1 for _ in jsonl.stream()))
+    return len(records) / write, len(records) / read
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=50000)
+    args = parser.parse_args()
+
+    print(f"{'shape':8} {'backend':9} {'test':10} {'write/s':>12} {'read/s':>12}")
+    for shape, make_record in SHAPES.items():
+        records = [make_record(i) for i in range(args.records)]
+        for name in backends.available_backends():
+            backend = backends.get_backend(name)
+            results = [("raw", bench_backend(backend, records))]
+            for extension in ["jsonl", "jsonl.gz"]:
+                results.append((extension, bench_jsonl(backend, records, extension)))
+            for test, (write, read) in results:
+                print(f"{shape:8} {name:9} {test:10} {write:12,.0f} {read:12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,3 @@
-from bobtools.datascan._dictscanner import DictScanner
+from bobtools.datascan._dictscanner import DictScanner, SchemaDrift, SchemaDriftError
 
-__all__ = [DictScanner]
+__all__ = [DictScanner, SchemaDrift, SchemaDriftError]
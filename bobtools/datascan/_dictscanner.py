@@ -1,26 +1,165 @@
+import bisect
 import logging
-from copy import deepcopy
+import pickle
+import random
+import zlib
 from dataclasses import InitVar, dataclass, field
-from typing import Callable, Dict, Iterable
+from typing import Callable, Dict, Iterable, List, NamedTuple, Union
 
-leaf = {"types": [], "prototype": None, "values": [], "count": 0}
+from bobtools.datascan._hyperloglog import HyperLogLog, hash64
+
+# number of example values kept per key path
+SAMPLE_SIZE = 10
+# version of the format written by DictScanner.to_bytes
+STATE_VERSION = 2
+
+
+class SchemaDrift(NamedTuple):
+    """A change in the schema seen by a DictScanner"""
+
+    # "new_path", "new_type", or "conflict" when a second type other than None
+    # turns up, making the path "multiple" in the schema
+    kind: str
+    trail: tuple
+    type: type
+    # the number of the record it showed up in
+    n_scanned: int
+
+
+class SchemaDriftError(Exception):
+    """Raised by a DictScanner with on_drift="raise", after the record is scanned"""
+
+    def __init__(self, events: List[SchemaDrift]):
+        Exception.__init__(self, ", ".join(f"{e.kind} at {e.trail}" for e in events))
+        self.events = events
+
+
+def _new_leaf() -> dict:
+    """Statistics of the values at one key path, in memory bounded per path"""
+    return {
+        # occurrences of each type, in the order they were first seen
+        "types": {},
+        "count": 0,
+        "nulls": 0,
+        # the last value that was not None
+        "prototype": None,
+        # [min, max] per type, None for types that can't be ordered
+        "bounds": {},
+        # sorted (hash, value) pairs of the distinct values with the lowest
+        # hashes, a uniform sample that does not depend on the scan order
+        "sample": [],
+        "distinct": HyperLogLog(),
+    }
 
 
 @dataclass
 class DictScanner:
+    """Infers the schema of (nested) dicts, keeping statistics per key path
+
+    Schema drift, a new key path or type, raises a version number. With an
+    `on_drift` callable, it is called with a SchemaDrift event for each
+    change as it happens; with on_drift="raise", scanning a record that
+    changes the schema raises a SchemaDriftError listing its events. This
+    costs nothing for values whose path and type were seen before.
+    """
+
     iterable: InitVar[Iterable] = None
     n_scanned: int = 0
     root: dict = field(default_factory=lambda: {})
+    # records scan_all read but left out by sampling
+    n_skipped: int = 0
+    on_drift: Union[Callable[[SchemaDrift], None], str, None] = field(
+        default=None, repr=False, compare=False
+    )
 
     def __post_init__(self, iterable: Iterable) -> None:
+        # goes up by one for every new key path and every new type of a path
+        self.version = len(self.root) + sum(
+            len(leaf["types"]) for leaf in self.root.values()
+        )
+        self._drift_events = []
+        # to_schema, and the version it is of
+        self._schema = None
+        self._schema_version = None
         if iterable:
             self.iterable = []
             self.scan_all(iterable)
         self.iterable = []
 
-    def scan_all(self, iterable: Iterable) -> None:
-        for i in iterable:
-            self.scan_this(i)
+    def scan_all(
+        self,
+        iterable: Iterable,
+        every: int = None,
+        fraction: float = None,
+        reservoir: int = None,
+        stop_after: int = None,
+        seed=None,
+    ) -> int:
+        """Scan the records of an iterable, or a sample of them
+
+        Parameters
+        ---
+        iterable : Iterable
+            The records to scan
+        every : int (default None)
+            Only scan every `every`th record, starting with the first
+        fraction : float (default None)
+            Scan a random `fraction` of the records
+        reservoir : int (default None)
+            Scan a uniform random sample of `reservoir` records, which are
+            kept in memory until the iterable is exhausted
+        stop_after : int (default None)
+            Stop once `stop_after` records in a row were scanned without any new
+            key path or type turning up, e.g. to infer the schema of a stable
+            feed from its first records. Can't be combined with `reservoir`.
+        seed : (default None)
+            Seed of the random sampling, for reproducible samples
+
+        Returns the number of records scanned, records that were read but not
+        scanned add to `n_skipped`.
+        """
+        options = [every, fraction, reservoir]
+        if sum(option is not None for option in options) > 1:
+            raise ValueError("Choose one of `every`, `fraction` and `reservoir`")
+        if reservoir is not None and stop_after is not None:
+            raise ValueError("A reservoir sample can't stop early")
+        rng = random.Random(seed)
+        if reservoir is not None:
+            records = self._reservoir(iterable, reservoir, rng)
+        else:
+            records = self._sample(iterable, every, fraction, rng)
+
+        n_scanned = n_stable = 0
+        for record in records:
+            version = self.version
+            self.scan_this(record)
+            n_scanned += 1
+            if stop_after is not None:
+                n_stable = n_stable + 1 if self.version == version else 0
+                if n_stable >= stop_after:
+                    break
+        return n_scanned
+
+    def _sample(self, iterable, every, fraction, rng):
+        for i, record in enumerate(iterable):
+            if every is not None and i % every:
+                self.n_skipped += 1
+            elif fraction is not None and rng.random() >= fraction:
+                self.n_skipped += 1
+            else:
+                yield record
+
+    def _reservoir(self, iterable, size, rng):
+        sample = []
+        for i, record in enumerate(iterable):
+            if i < size:
+                sample.append(record)
+                continue
+            self.n_skipped += 1
+            j = rng.randrange(i + 1)
+            if j < size:
+                sample[j] = record
+        return sample
 
     def scan_one(self, iterable: Iterable) -> None:
         for i in iterable:
@@ -30,12 +169,84 @@ class DictScanner:
 
     def scan_this(self, example: Dict) -> None:
         self.n_scanned += 1
-        flat_example = self._flatten(example)
-        self._update_root(flat_example)
+        self._update_root(example)
+        if self._drift_events:
+            self._raise_drift()
 
     def schema(self):
         pass
 
+    def merge(self, other: "DictScanner") -> "DictScanner":
+        """Add the state of another scanner to this one, returns this scanner
+
+        The result is the same as if this scanner had gone on to scan the
+        records `other` scanned, so scanners of consecutive shards, merged in
+        order, give the schema, prototype and statistics of a sequential scan:
+
+        shards = pool.run(
+            paths, lambda path: DictScanner(JSONL(path).stream()).to_bytes()
+        )
+        scanner = functools.reduce(
+            DictScanner.merge, map(DictScanner.from_bytes, shards), DictScanner()
+        )
+        """
+        self.n_scanned += other.n_scanned
+        self.n_skipped += other.n_skipped
+        for trail, other_leaf in other.root.items():
+            node = self.root.get(trail)
+            new_path = node is None
+            if new_path:
+                node = self.root[trail] = _new_leaf()
+                self.version += 1
+            self._merge_leaf(trail, node, other_leaf, new_path)
+        if self._drift_events:
+            self._raise_drift()
+        return self
+
+    def _merge_leaf(self, trail: tuple, node: dict, other: dict, new_path) -> None:
+        types = node["types"]
+        for t, n in other["types"].items():
+            if t not in types:
+                types[t] = 0
+                self.version += 1
+                if self.on_drift is not None:
+                    self._drift(trail, types, t, new_path)
+                new_path = False
+            types[t] += n
+        node["count"] += other["count"]
+        node["nulls"] += other["nulls"]
+        if other["prototype"] is not None:
+            node["prototype"] = other["prototype"]
+        bounds = node["bounds"]
+        for t, bound in other["bounds"].items():
+            if t not in bounds:
+                bounds[t] = bound and list(bound)
+            elif bounds[t] is None or bound is None:
+                bounds[t] = None
+            else:
+                DictScanner._update_bounds(bounds, t, bound[0])
+                DictScanner._update_bounds(bounds, t, bound[1])
+        for hashed, v in other["sample"]:
+            DictScanner._update_sample(node["sample"], hashed, v)
+        node["distinct"].merge(other["distinct"])
+
+    def to_bytes(self) -> bytes:
+        """Serialize the scanner state, compressed, see `from_bytes`"""
+        state = (STATE_VERSION, self.n_scanned, self.n_skipped, self.root)
+        return zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "DictScanner":
+        """Restore a scanner serialized with `to_bytes`
+
+        The state is pickled, so only load data from trusted sources.
+        """
+        state = pickle.loads(zlib.decompress(data))
+        if state[0] != STATE_VERSION:
+            raise ValueError(f"Unsupported DictScanner state version {state[0]}")
+        _, n_scanned, n_skipped, root = state
+        return cls(n_scanned=n_scanned, root=root, n_skipped=n_skipped)
+
     @staticmethod
     def _mergedict(nested_dict: dict) -> dict:
         newdict = {}
@@ -83,40 +294,147 @@ class DictScanner:
         return DictScanner._mergedict(reconstructed_dict)
 
     def to_schema(self) -> dict:
-        schema_from_leaf = (
-            lambda v: v["types"][0]
-            if len(set(v["types"]).difference(set([type(None)]))) <= 1
-            else "multiple"
-        )
-        return self._reconstruct_dict(self.root, extractor=schema_from_leaf)
+        """The schema of the records scanned so far
+
+        The schema is only rebuilt when the version changed, the same dict is
+        returned until then, so copy it before making changes to it.
+        """
+        if self._schema_version == self.version:
+            return self._schema
+
+        def schema_from_leaf(v):
+            if len(set(v["types"]).difference(set([type(None)]))) <= 1:
+                return next(iter(v["types"]))
+            return "multiple"
+
+        self._schema = self._reconstruct_dict(self.root, extractor=schema_from_leaf)
+        self._schema_version = self.version
+        return self._schema
 
     def to_prototype(self) -> dict:
         prototype_from_leaf = lambda v: v["prototype"]  # noqa
         return self._reconstruct_dict(self.root, prototype_from_leaf)
 
-    @staticmethod
-    def _flatten(datamap, trail: tuple = ()) -> dict:
-        flatmap = {}
-        if type(datamap) != dict:
-            return {trail: datamap}
-        for k, v in datamap.items():
-            loc = trail + (k,)
-            if type(v) == dict:
-                flatmap.update(DictScanner._flatten(v, loc))
-            elif type(v) == list:
-                loc = trail + (k, "__list__")
-                for child in v:
-                    flatmap.update(DictScanner._flatten(child, loc))
+    def to_stats(self) -> dict:
+        """Statistics of the values at every key path, by path
+
+        For each path: the number of values, of which None, the occurrences of
+        each type, the [min, max] of each type that can be ordered, an
+        approximate number of distinct values and a sample of distinct values.
+        """
+        return {
+            trail: {
+                "count": v["count"],
+                "nulls": v["nulls"],
+                "types": dict(v["types"]),
+                "bounds": {t: b and tuple(b) for t, b in v["bounds"].items()},
+                "distinct": v["distinct"].count(),
+                "sample": [value for _, value in v["sample"]],
+            }
+            for trail, v in self.root.items()
+        }
+
+    def _update_root(self, example) -> None:
+        """Add every value in a (nested) record to the leaf of its key path
+
+        Walks the record depth-first without recursion, keeping an iterator per
+        level. Values in lists are added at the path of the list, with a
+        "__list__" key.
+        """
+        update_leaf = self._update_leaf
+        if type(example) is not dict:
+            update_leaf((), example)
+            return
+        # (trail, iterator over the items of a dict or the children of a list,
+        # whether it is a list)
+        stack = [((), iter(example.items()), False)]
+        while stack:
+            trail, items, in_list = stack[-1]
+            if in_list:
+                for v in items:
+                    if type(v) is dict:
+                        stack.append((trail, iter(v.items()), False))
+                        break
+                    # lists in lists are values
+                    update_leaf(trail, v)
+                else:
+                    stack.pop()
+                continue
+            for k, v in items:
+                if type(v) is dict:
+                    stack.append((trail + (k,), iter(v.items()), False))
+                    break
+                if type(v) is list:
+                    stack.append((trail + (k, "__list__"), iter(v), True))
+                    break
+                update_leaf(trail + (k,), v)
             else:
-                flatmap[loc] = v
-        return flatmap
-
-    def _update_root(self, flatdict: Dict):
-        for trail, v in flatdict.items():
-            if trail not in self.root:
-                self.root[trail] = deepcopy(leaf)
-            self.root[trail]["types"].append(type(v))
-            self.root[trail]["count"] += 1
-            self.root[trail]["values"].append(v)
-            if not isinstance(v, type(None)):
-                self.root[trail]["prototype"] = v
+                stack.pop()
+
+    def _update_leaf(self, trail: tuple, v) -> None:
+        node = self.root.get(trail)
+        new_path = node is None
+        if new_path:
+            node = self.root[trail] = _new_leaf()
+            self.version += 1
+        t = type(v)
+        types = node["types"]
+        if t in types:
+            types[t] += 1
+        else:
+            types[t] = 1
+            self.version += 1
+            if self.on_drift is not None:
+                self._drift(trail, types, t, new_path)
+        node["count"] += 1
+        if v is None:
+            node["nulls"] += 1
+            return
+        node["prototype"] = v
+        self._update_bounds(node["bounds"], t, v)
+        hashed = hash64(v)
+        node["distinct"].add(hashed)
+        self._update_sample(node["sample"], hashed, v)
+
+    def _drift(self, trail: tuple, types: dict, t: type, new_path: bool) -> None:
+        """Report type `t`, that was just added to `types`, as drift"""
+        kind = "new_path" if new_path else "new_type"
+        events = [SchemaDrift(kind, trail, t, self.n_scanned)]
+        n_types = len(types) - (type(None) in types)
+        if t is not type(None) and n_types == 2:
+            events.append(SchemaDrift("conflict", trail, t, self.n_scanned))
+        if self.on_drift == "raise":
+            self._drift_events.extend(events)
+        else:
+            for event in events:
+                self.on_drift(event)
+
+    def _raise_drift(self):
+        events, self._drift_events = self._drift_events, []
+        raise SchemaDriftError(events)
+
+    @staticmethod
+    def _update_bounds(bounds: dict, t: type, v) -> None:
+        if t not in bounds:
+            bounds[t] = [v, v]
+        bound = bounds[t]
+        if bound is None:
+            return
+        try:
+            if v < bound[0]:
+                bound[0] = v
+            elif v > bound[1]:
+                bound[1] = v
+        except TypeError:
+            bounds[t] = None
+
+    @staticmethod
+    def _update_sample(sample: list, hashed: int, v) -> None:
+        if len(sample) >= SAMPLE_SIZE and hashed >= sample[-1][0]:
+            return
+        i = bisect.bisect_left(sample, (hashed,))
+        if i < len(sample) and sample[i][0] == hashed:
+            return
+        sample.insert(i, (hashed, v))
+        if len(sample) > SAMPLE_SIZE:
+            sample.pop()
@@ -0,0 +1,61 @@
+"""HyperLogLog distinct counting, on 64-bit hashes computed by the caller"""
+
+import hashlib
+import math
+
+HLL_PRECISION = 10
+
+
+def hash64(value) -> int:
+    """Stable 64-bit hash of a value, the same in every process and run"""
+    if type(value) is str:
+        data = b"s" + value.encode("utf-8", "surrogatepass")
+    else:
+        data = repr(value).encode("utf-8", "backslashreplace")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+
+class HyperLogLog:
+    """Approximate number of distinct values in a fixed 2 ** precision bytes
+
+    The relative error is about 1.04 / sqrt(2 ** precision), 3% with the
+    default precision. Sketches of the same precision merge exactly.
+    """
+
+    __slots__ = ("precision", "registers")
+
+    def __init__(self, precision=HLL_PRECISION, registers: bytes = None):
+        self.precision = precision
+        self.registers = bytearray(registers or 1 << precision)
+
+    def add(self, hashed: int) -> None:
+        """Add a value by its 64-bit hash (see `hash64`)"""
+        bits = 64 - self.precision
+        index = hashed >> bits
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> None:
+        if other.precision != self.precision:
+            raise ValueError("Can only merge HyperLogLogs of the same precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        m = len(self.registers)
+        zeros = self.registers.count(0)
+        if zeros == m:
+            return 0
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m
+        estimate /= sum(2.0**-r for r in self.registers)
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+    def __eq__(self, other):
+        return (
+            type(other) is HyperLogLog
+            and self.precision == other.precision
+            and self.registers == other.registers
+        )
@@ -1,3 +1,5 @@
+from bobtools.io.async_jsonl import AsyncJSONL
 from bobtools.io.jsonl import JSONL
+from bobtools.io.sharded import ShardedJSONL
 
-__all__ = [JSONL]
+__all__ = [JSONL, AsyncJSONL, ShardedJSONL]
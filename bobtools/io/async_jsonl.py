@@ -0,0 +1,149 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncGenerator, AsyncIterable, Iterable, Union
+
+from bobtools.io.jsonl import JSONL
+
+
+def _take(iterator, n: int) -> list:
+    """Take up to n items from an iterator"""
+    batch = []
+    for item in iterator:
+        batch.append(item)
+        if len(batch) == n:
+            break
+    return batch
+
+
+class AsyncJSONL:
+    """asyncio counterpart of JSONL
+
+    All file I/O, (de)serialization and compression runs on a single background
+    thread, so the event loop is never blocked and operations on the file stay
+    in order. Appended objects are collected into batches of `batch_size`; at most
+    `max_pending` batches wait for the writer thread before `append` blocks, which
+    bounds memory when producers are faster than the disk.
+
+    Other keyword arguments are passed on to JSONL.
+    """
+
+    def __init__(self, filename, batch_size=1000, max_pending=4, **kwargs):
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._jsonl = JSONL(filename, **kwargs)
+        self._batch = []
+        self._pending = set()
+        self._slots = None
+        self._closed = False
+
+    @property
+    def filename(self) -> str:
+        return self._jsonl.filename
+
+    @property
+    def written(self) -> int:
+        return self._jsonl.written
+
+    @property
+    def n_read(self) -> int:
+        return self._jsonl.n_read
+
+    def __repr__(self):
+        return repr(self._jsonl)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type=None, value=None, traceback=None):
+        await self.close()
+
+    def _run(self, func, *args):
+        """Run a (blocking) JSONL operation on the background thread"""
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _submit_batch(self) -> None:
+        """Hand the current batch to the writer thread, waiting for a free slot"""
+        if not self._batch:
+            return
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        batch, self._batch = self._batch, []
+        await self._slots.acquire()
+        future = self._run(self._jsonl.extend, batch)
+        self._pending.add(future)
+        future.add_done_callback(self._batch_done)
+
+    def _batch_done(self, future) -> None:
+        self._slots.release()
+        # keep failed batches around, so the error is raised on the next flush
+        if future.cancelled() or not future.exception():
+            self._pending.discard(future)
+
+    async def append(self, object: Union[dict, str, int, float, list, tuple]) -> None:
+        """Add an object to the file (see JSONL.append)"""
+        self._batch.append(object)
+        if len(self._batch) >= self.batch_size:
+            await self._submit_batch()
+
+    async def extend(
+        self,
+        object_iterable: Union[
+            Iterable[Union[dict, str, int, float, list, tuple]],
+            AsyncIterable[Union[dict, str, int, float, list, tuple]],
+        ],
+    ) -> None:
+        """Appends each object in an (async) iterable to the file"""
+        if hasattr(object_iterable, "__aiter__"):
+            async for obj in object_iterable:
+                await self.append(obj)
+        else:
+            for obj in object_iterable:
+                await self.append(obj)
+
+    async def flush(self) -> None:
+        """Wait until all appended objects are written and flush the file"""
+        await self._submit_batch()
+        pending, self._pending = list(self._pending), set()
+        await asyncio.gather(*pending)
+        await self._run(self._jsonl.flush)
+
+    async def close(self) -> None:
+        """Flush and close the file, and stop the background thread"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            await self.flush()
+            await self._run(self._jsonl.close)
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def readline(self) -> Union[dict, str, int, float, list, tuple]:
+        await self.flush()
+        return await self._run(self._jsonl.readline)
+
+    async def read(self) -> list:
+        """Read all objects in the file into a list (see JSONL.read)"""
+        await self.flush()
+        return await self._run(self._jsonl.read)
+
+    async def stream(
+        self, batch_size: int = None, **kwargs
+    ) -> AsyncGenerator[Union[dict, str, int, float, list, tuple], None]:
+        """Yield objects from file one-by-one (see JSONL.stream)
+
+        Objects are read in batches of `batch_size` on the background thread, the
+        next batch is only read once the current one is consumed.
+        """
+        await self.flush()
+        stream = self._jsonl.stream(**kwargs)
+        while True:
+            batch = await self._run(_take, stream, batch_size or self.batch_size)
+            if not batch:
+                break
+            for obj in batch:
+                yield obj
+
+    def __aiter__(self):
+        return self.stream()
@@ -0,0 +1,125 @@
+"""JSON (de)serialization backends for JSONL
+
+The fastest installed backend is picked by default, in the order of
+`BACKEND_PREFERENCE`; the standard library `json` module is always available.
+Backends differ in details such as whitespace, but write the same data:
+objects a backend can't serialize (e.g. integers beyond 64 bits in orjson)
+are written with `json` instead, as are the NaN and Infinity floats orjson
+would turn into null.
+"""
+
+import importlib.util
+import json
+import math
+from typing import Callable, NamedTuple, Optional
+
+BACKEND_PREFERENCE = ["orjson", "ujson", "simdjson", "json"]
+
+
+class JSONBackend(NamedTuple):
+    name: str
+    # serialize to a str
+    dumps: Callable[[object], str]
+    # deserialize from a str or bytes(-like) object
+    loads: Callable[[object], object]
+    # serialize directly to bytes, None if the backend can only produce str
+    dumpb: Optional[Callable[[object], bytes]] = None
+
+
+def _has_nonfinite(obj) -> bool:
+    """Whether a (nested) object holds a NaN or infinite float"""
+    if type(obj) is float:
+        return not math.isfinite(obj)
+    if type(obj) is dict:
+        return any(_has_nonfinite(value) for value in obj.values())
+    if type(obj) in (list, tuple):
+        return any(_has_nonfinite(value) for value in obj)
+    return False
+
+
+def _load_orjson() -> JSONBackend:
+    import orjson
+
+    def dumpb(obj):
+        try:
+            line = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except (TypeError, OverflowError):
+            # json raises in turn if the object really can't be serialized
+            return json.dumps(obj).encode()
+        if b"null" in line and _has_nonfinite(obj):
+            return json.dumps(obj).encode()
+        return line
+
+    def loads(line):
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # NaN and Infinity, as written by json
+            return json.loads(line)
+
+    return JSONBackend("orjson", lambda obj: dumpb(obj).decode(), loads, dumpb=dumpb)
+
+
+def _load_ujson() -> JSONBackend:
+    import ujson
+
+    def dumps(obj):
+        try:
+            return ujson.dumps(obj)
+        except (TypeError, OverflowError):
+            return json.dumps(obj)
+
+    return JSONBackend("ujson", dumps, ujson.loads)
+
+
+def _load_simdjson() -> JSONBackend:
+    import simdjson
+
+    # simdjson only speeds up parsing
+    return JSONBackend("simdjson", json.dumps, simdjson.loads)
+
+
+def _load_json() -> JSONBackend:
+    def loads(line):
+        # json.loads detects the encoding of bytes in Python, decoding is faster
+        if type(line) == bytes:
+            line = line.decode()
+        return json.loads(line)
+
+    return JSONBackend("json", json.dumps, loads)
+
+
+_LOADERS = {
+    "orjson": _load_orjson,
+    "ujson": _load_ujson,
+    "simdjson": _load_simdjson,
+    "json": _load_json,
+}
+_BACKENDS = {}
+
+
+def available_backends() -> list:
+    """Names of the backends that can be imported, fastest first"""
+    available = []
+    for name in BACKEND_PREFERENCE:
+        if importlib.util.find_spec(name) is not None or name == "json":
+            available.append(name)
+    return available
+
+
+def get_backend(name: str = None) -> JSONBackend:
+    """Return the backend called `name`, or the fastest available one if None
+
+    Raises:
+        ValueError: if `name` is not a known backend
+        ImportError: if the package for backend `name` is not installed
+    """
+    if name is None:
+        name = available_backends()[0]
+    if name not in _LOADERS:
+        raise ValueError(
+            f"Unknown JSON backend {name}, choose from {', '.join(BACKEND_PREFERENCE)}"
+        )
+    if name not in _BACKENDS:
+        _BACKENDS[name] = _LOADERS[name]()
+    return _BACKENDS[name]
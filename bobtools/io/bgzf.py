@@ -0,0 +1,196 @@
+"""Block-gzip (BGZF-style) files for line based data
+
+A block-gzip file is a series of independently compressed gzip members. Every
+member holds whole lines only, and carries its compressed size and line count in
+a gzip 'extra' subfield. Because concatenated members are valid gzip, the files
+can still be read by `gzip -d` or `gzip.open`, while blocks can be located by
+hopping from header to header and decompressed individually (or concurrently).
+"""
+
+import gzip
+import io
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, NamedTuple
+
+BLOCK_SIZE = 65536
+SUBFIELD_ID = b"BJ"
+
+# magic, method, flags (FEXTRA), mtime, xfl, os, xlen, subfield id, subfield length,
+# compressed member size, number of lines in the member
+_HEADER = struct.Struct("<BBBBIBBH2sHII")
+_TRAILER = struct.Struct("<II")
+_EXTRA_LENGTH = 12
+_SUBFIELD_LENGTH = 8
+
+
+class Block(NamedTuple):
+    offset: int
+    size: int
+    first_line: int
+    n_lines: int
+
+
+def compress_block(data: bytes, compresslevel: int = 6) -> bytes:
+    """Compress (a whole number of lines of) data into a single gzip member"""
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    size = _HEADER.size + len(deflated) + _TRAILER.size
+    header = _HEADER.pack(
+        0x1F,
+        0x8B,
+        8,
+        4,
+        0,
+        0,
+        255,
+        _EXTRA_LENGTH,
+        SUBFIELD_ID,
+        _SUBFIELD_LENGTH,
+        size,
+        data.count(b"\n"),
+    )
+    trailer = _TRAILER.pack(zlib.crc32(data), len(data) & 0xFFFFFFFF)
+    return header + deflated + trailer
+
+
+def decompress_block(block: bytes) -> bytes:
+    """Decompress a single member as written by `compress_block`"""
+    data = zlib.decompress(block[_HEADER.size : -_TRAILER.size], -zlib.MAX_WBITS)
+    crc, _ = _TRAILER.unpack(block[-_TRAILER.size :])
+    if zlib.crc32(data) != crc:
+        raise ValueError("CRC check failed on block-gzip member")
+    return data
+
+
+def read_block_index(fileobj, offset: int = 0, first_line: int = 0) -> List[Block]:
+    """List the blocks in a binary file object, starting at byte `offset`
+
+    Only the headers are read, so this is cheap even for very large files.
+    """
+    blocks = []
+    while True:
+        fileobj.seek(offset)
+        header = fileobj.read(_HEADER.size)
+        if not header:
+            break
+        if len(header) < _HEADER.size:
+            raise ValueError(f"Truncated block-gzip header at offset {offset}")
+        fields = _HEADER.unpack(header)
+        if fields[:4] != (0x1F, 0x8B, 8, 4) or fields[8] != SUBFIELD_ID:
+            raise ValueError(f"No block-gzip member at offset {offset}")
+        size, n_lines = fields[10], fields[11]
+        blocks.append(Block(offset, size, first_line, n_lines))
+        offset += size
+        first_line += n_lines
+    return blocks
+
+
+def read_blocks(
+    fileobj, blocks: Iterable[Block], max_workers: int = None
+) -> Iterator[bytes]:
+    """Yield the decompressed contents of `blocks`, in order
+
+    The compressed blocks are read sequentially, decompression (which releases
+    the GIL) runs concurrently on `max_workers` threads.
+    """
+
+    def raw_blocks():
+        for block in blocks:
+            fileobj.seek(block.offset)
+            yield fileobj.read(block.size)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(decompress_block, raw_blocks())
+
+
+class BGZFFile(io.IOBase):
+    """File object for block-gzip files
+
+    In read mode, behaves like a `gzip.GzipFile`. In write or append mode, data
+    is buffered and written as a block-gzip member once `block_size` bytes
+    are pending, cutting blocks at line endings.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        mode: str = "rb",
+        compresslevel: int = 6,
+        block_size: int = BLOCK_SIZE,
+    ):
+        self.name = filename
+        self.mode = mode
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self._buffer = bytearray()
+        if "r" in mode:
+            self._fileobj = gzip.GzipFile(filename, mode="rb")
+        elif "a" in mode or "w" in mode:
+            self._fileobj = open(filename, mode="ab" if "a" in mode else "wb")
+        else:
+            raise ValueError(f"Invalid mode: {mode}")
+
+    @property
+    def closed(self) -> bool:
+        return self._fileobj.closed
+
+    def readable(self) -> bool:
+        return "r" in self.mode
+
+    def writable(self) -> bool:
+        return "r" not in self.mode
+
+    def seekable(self) -> bool:
+        return self.readable()
+
+    def read(self, size: int = -1) -> bytes:
+        return self._fileobj.read(size)
+
+    def readline(self, size: int = -1) -> bytes:
+        return self._fileobj.readline(size)
+
+    def __iter__(self):
+        return iter(self._fileobj)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self._fileobj.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._fileobj.tell()
+
+    def write(self, data: bytes) -> int:
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.block_size:
+            cut = self._buffer.rfind(b"\n", 0, self.block_size) + 1
+            if not cut:
+                # a single line longer than a block gets a block of its own
+                cut = self._buffer.find(b"\n", self.block_size) + 1
+                if not cut:
+                    break
+            self._write_block(cut)
+        return len(data)
+
+    def _write_block(self, size: int) -> None:
+        self._fileobj.write(
+            compress_block(bytes(self._buffer[:size]), self.compresslevel)
+        )
+        del self._buffer[:size]
+
+    def flush(self) -> None:
+        """Write out all complete lines as a block and flush the file"""
+        if self.closed:
+            return
+        if self.writable():
+            cut = self._buffer.rfind(b"\n") + 1
+            if cut:
+                self._write_block(cut)
+        self._fileobj.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        if self.writable() and self._buffer:
+            self._write_block(len(self._buffer))
+        self._fileobj.close()
@@ -2,19 +2,230 @@ import atexit
 import gzip
 import json
 import logging
+import mmap
 import os
-from typing import Generator, Iterable, Union
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import (
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import cloudpickle
+
+from bobtools.io import backends, bgzf
 
 OPENERS = {
-    "gzip": {"object": gzip.GzipFile, "read_mode": "rb+", "append_mode": "ab+"},
-    "gz": {"object": gzip.GzipFile, "read_mode": "rb+", "append_mode": "ab+"},
-    "default": {"object": open, "read_mode": "r+", "append_mode": "a+"},
+    "gzip": {
+        "object": gzip.GzipFile,
+        "read_mode": "rb+",
+        "append_mode": "ab+",
+        "raw_read_mode": "rb",
+    },
+    "gz": {
+        "object": gzip.GzipFile,
+        "read_mode": "rb+",
+        "append_mode": "ab+",
+        "raw_read_mode": "rb",
+    },
+    "bgz": {
+        "object": bgzf.BGZFFile,
+        "read_mode": "rb",
+        "append_mode": "ab",
+        "raw_read_mode": "rb",
+        "blocks": True,
+    },
+    "bgzf": {
+        "object": bgzf.BGZFFile,
+        "read_mode": "rb",
+        "append_mode": "ab",
+        "raw_read_mode": "rb",
+        "blocks": True,
+    },
+    "default": {
+        "object": open,
+        "read_mode": "r+",
+        "append_mode": "a+",
+        "raw_read_mode": "rb",
+    },
 }
 
+INDEX_EXTENSION = "idx"
+SHARD_SIZE = 16 * 1024 * 1024
+MMAP_CHUNK_SIZE = 1024 * 1024
+# NumPy dtypes for the python types found by bobtools.datascan.DictScanner.to_schema
+PY_TO_DTYPE = {int: "int64", float: "float64", bool: "bool", str: "object"}
+
+
+def _deserialize(
+    line: Union[str, bytes],
+    skip_unserializable_objects: bool = False,
+    loads: Callable = json.loads,
+) -> Union[dict, str, int, float, list, tuple]:
+    """Deserialize to a object from a JSON (byte-)string,
+    ignoring errors if so configured.
+    """
+    try:
+        # all backends parse bytes directly, without decoding to str first
+        return loads(line)
+    except Exception as e:
+        if skip_unserializable_objects:
+            return
+        raise e
+
+
+class _Query:
+    """Pre-check, filter and projection applied to lines while streaming
+
+    Lines that do not contain all `contains` substrings are skipped before they
+    are parsed. Parsed objects are dropped if `where(obj)` is falsy, and reduced
+    to the values at the key paths in `fields` (dotted strings or tuples of keys).
+    """
+
+    def __init__(
+        self,
+        fields: Sequence[Union[str, tuple]] = None,
+        where: Callable = None,
+        contains: Union[str, bytes, Sequence[Union[str, bytes]]] = None,
+    ):
+        self.fields = None
+        if fields is not None:
+            self.fields = [
+                (field, tuple(field.split(".")) if type(field) == str else field)
+                for field in fields
+            ]
+        self.where = where
+        if isinstance(contains, (str, bytes)):
+            contains = [contains]
+        contains = contains or []
+        self.contains_str = [c.decode() if type(c) == bytes else c for c in contains]
+        self.contains_bytes = [c.encode() if type(c) == str else c for c in contains]
+
+    def check_line(self, line: Union[str, bytes]) -> bool:
+        """Cheap pre-check on the raw line"""
+        needles = self.contains_bytes if type(line) == bytes else self.contains_str
+        for needle in needles:
+            if needle not in line:
+                return False
+        return True
+
+    @staticmethod
+    def _get_path(obj, path: tuple):
+        for key in path:
+            try:
+                if type(obj) == list:
+                    key = int(key)
+                obj = obj[key]
+            except (KeyError, IndexError, TypeError, ValueError):
+                return None
+        return obj
+
+    def select(self, obj) -> tuple:
+        """Return (keep, projected object) for a parsed object"""
+        if obj is None:
+            # unparseable lines (if skipped) are passed on as-is
+            return True, obj
+        if self.where is not None and not self.where(obj):
+            return False, None
+        if self.fields is None:
+            return True, obj
+        return True, {name: self._get_path(obj, path) for name, path in self.fields}
+
+
+def _flatten_schema(schema: dict, trail: tuple = ()) -> dict:
+    """Map dotted key paths in a (nested) schema to NumPy dtypes"""
+    dtypes = {}
+    for key, value in schema.items():
+        loc = trail + (str(key),)
+        if type(value) == dict:
+            dtypes.update(_flatten_schema(value, loc))
+        elif type(value) is list:
+            # the schema of the items of a list, the column holds the lists
+            dtypes[".".join(loc)] = "object"
+        else:
+            dtypes[".".join(loc)] = PY_TO_DTYPE.get(value, "object")
+    return dtypes
+
+
+def _object_array(values: list):
+    """1-D object array, also when the values are (equal length) lists"""
+    import numpy as np
+
+    array = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        array[i] = value
+    return array
+
+
+def _column_to_array(values: list, dtype=None):
+    """Convert a batch of column values to a NumPy array
+
+    Without a dtype, it is inferred per batch (strings and nested values become
+    object arrays). Values that do not fit the dtype, such as missing values in
+    an integer column, make the batch fall back to an object array.
+    """
+    import numpy as np
+
+    try:
+        array = np.asarray(values, dtype=dtype)
+    except (TypeError, ValueError, OverflowError):
+        return _object_array(values)
+    if array.ndim != 1 or array.dtype.kind in "US":
+        return _object_array(values)
+    return array
+
+
+def _parse_shard(
+    filename: str,
+    start: int,
+    stop: int,
+    compressed: bool,
+    skip: bool,
+    backend: str,
+    query: bytes = None,
+) -> Tuple[int, list]:
+    """Read and deserialize the lines in bytes `start` to `stop` of a file
+
+    Shards of compressed (block-gzip) files consist of whole gzip members.
+    Returns the number of lines read and the (selected) objects.
+    """
+    with open(filename, "rb") as f:
+        f.seek(start)
+        data = f.read(stop - start)
+    if compressed:
+        members = []
+        while data:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            members.append(decompressor.decompress(data))
+            data = decompressor.unused_data
+        data = b"".join(members)
+    loads = backends.get_backend(backend).loads
+    lines = data.splitlines()
+    if query is None:
+        return len(lines), [_deserialize(line, skip, loads) for line in lines]
+    query = cloudpickle.loads(query)
+    objects = []
+    for line in lines:
+        if query.check_line(line):
+            keep, obj = query.select(_deserialize(line, skip, loads))
+            if keep:
+                objects.append(obj)
+    return len(lines), objects
+
 
 class JSONL:
 
     written = 0
+    bytes_written = 0
     n_read = 0
     extension = ""
     new = False
@@ -22,28 +233,66 @@ class JSONL:
     _fileobj = None
     print_on_exit = False
     skip_unserializable_objects = False
+    write_buffer_size = 65536
+    _mode = None
+    index = False
+    _offsets = None
+    _offsets_saved = 0
+    _index_fileobj = None
+    _blocks = None
+    _blocks_stale = True
+    _block_cache = None
+    use_mmap = False
 
     line_end = "\n"
 
     def __init__(
-        self, filename, skip_unserializable_objects=False, print_on_exit=False
+        self,
+        filename,
+        skip_unserializable_objects=False,
+        print_on_exit=False,
+        write_buffer_size=65536,
+        index=False,
+        json_backend=None,
+        use_mmap=False,
     ):
         # absorbed attributes
         self.print_on_exit = print_on_exit
+        self.index = index
+        self.json_backend = backends.get_backend(json_backend)
+        self.use_mmap = use_mmap
+        self.skip_unserializable_objects = skip_unserializable_objects
+        self.write_buffer_size = write_buffer_size
         self.filename = filename
+        # write buffer, see JSONL.flush
+        self._write_buffer = []
+        self._write_buffer_len = 0
         # inferred attributes
         self.extension = filename.rsplit(".", 1)[1] if "." in filename else "JSONL"
         self.opener = OPENERS.get(self.extension, OPENERS.get("default"))
+        # binary files skip the str step if the backend can serialize to bytes
+        self._buffer_bytes = bool(
+            self.json_backend.dumpb and self.opener["append_mode"] in ["ab", "ab+"]
+        )
         self.new = not self.exists()
+        self.index_filename = f"{filename}.{INDEX_EXTENSION}"
+        if self.new and self.index and not self.opener.get("blocks"):
+            # an empty file has a trivially known index
+            self._offsets = array("Q", [0])
+            self._offsets_saved = 0
         self.open()
         atexit.register(self.__exit__)
 
     def open(self, for_read: bool = False):
-        """(Re)-opens file """
+        """(Re)-opens file"""
         mode = (
             self.opener.get("read_mode") if for_read else self.opener.get("append_mode")
         )
+        if self._fileobj is not None and not self._fileobj.closed:
+            self._fileobj.close()
         self._fileobj = self.opener["object"](self.filename, mode=mode)
+        # GzipFile reports its mode as an int, so keep track of it ourselves
+        self._mode = mode
 
     def __repr__(self):
         is_open = not self.closed()
@@ -72,71 +321,320 @@ class JSONL:
         self.__exit__()
 
     def __exit__(self, type=None, value=None, traceback=None):
-        self._fileobj.close()
+        if self._fileobj is None:
+            return
+        self.close()
         if self.print_on_exit:
             print(self)
 
     def close(self):
+        """Flush any buffered lines and close the file"""
+        # reopens the file when a read closed it
+        self._flush_buffer()
         self._fileobj.close()
+        if self._index_fileobj is not None:
+            self._index_fileobj.close()
+        self._save_index()
+
+    def flush(self) -> None:
+        """Write buffered lines to the file and flush the underlying file object"""
+        self._flush_buffer()
+        if not self.closed() and self._mode == self.opener["append_mode"]:
+            self._fileobj.flush()
+        self._save_index()
 
     def serialize_to_line(
         self, object: Union[dict, str, int, float, list, tuple]
     ) -> str:
         """Serialize an object to a JSON string, ignoring errors if so configured"""
         try:
-            return json.dumps(object)
+            return self.json_backend.dumps(object)
         except Exception as e:
             if self.skip_unserializable_objects:
                 return
             raise e
 
-    def deserialize_line(
-        self, line: Union[str, bytes]
-    ) -> Union[dict, str, int, float, list, tuple]:
-        """Deserialize to a object from a JSON (byte-)string,
-         ignoring errors if so configured.
-        """
+    def _serialize(
+        self, object: Union[dict, str, int, float, list, tuple]
+    ) -> Union[str, bytes]:
+        """Serialize an object for the write buffer, as bytes if possible"""
+        if not self._buffer_bytes:
+            return self.serialize_to_line(object)
         try:
-            if type(line) == str:
-                return json.loads(line)
-            elif type(line) == bytes:
-                return json.loads(line.decode())
+            return self.json_backend.dumpb(object)
         except Exception as e:
             if self.skip_unserializable_objects:
                 return
             raise e
 
+    def deserialize_line(
+        self, line: Union[str, bytes]
+    ) -> Union[dict, str, int, float, list, tuple]:
+        """Deserialize to a object from a JSON (byte-)string,
+        ignoring errors if so configured.
+        """
+        return _deserialize(
+            line, self.skip_unserializable_objects, self.json_backend.loads
+        )
+
     def _assure_apendmode(self):
         """If file is not opened for appending, open file for appending."""
-        if self.closed() or self._fileobj.mode != self.opener["append_mode"]:
+        if self.closed() or self._mode != self.opener["append_mode"]:
             self.open(for_read=False)
 
     def _assure_readmode(self):
         """If file is not open for reading, open file for reading"""
-        if self.closed() or self._fileobj.mode != self.opener["read_mode"]:
+        self._flush_buffer()
+        if self.closed() or self._mode != self.opener["read_mode"]:
             self.open(for_read=True)
 
-    def append(self, object: Union[dict, str, int, float, list, tuple]) -> None:
-        """Add an object to the file"""
-        self._assure_apendmode()
-        line = self.serialize_to_line(object) + self.line_end
-        if not line:
-            return
+    def _buffer_line(self, line: Union[str, bytes]) -> None:
+        """Add a serialized line to the write buffer, writing it out when full"""
+        size = len(line) + 1
+        if type(line) == str and not line.isascii():
+            size = len(line.encode()) + 1
         self.written += 1
-        if self.opener["append_mode"] in ["ab", "ab+"]:
-            self._fileobj.write(line.encode())
+        self.bytes_written += size
+        self._write_buffer.append(line)
+        self._write_buffer_len += size
+        if self._write_buffer_len >= self.write_buffer_size:
+            self._flush_buffer()
+
+    def _flush_buffer(self) -> None:
+        """Write all buffered lines to the file in a single call"""
+        if not self._write_buffer:
+            return
+        self._assure_apendmode()
+        if self._buffer_bytes:
+            line_end = self.line_end.encode()
+            data = line_end.join(self._write_buffer) + line_end
+        else:
+            data = self.line_end.join(self._write_buffer) + self.line_end
+        if self._offsets is not None:
+            self._extend_index(self._write_buffer)
+        self._blocks_stale = True
+        self._write_buffer = []
+        self._write_buffer_len = 0
+        if self._buffer_bytes:
+            self._fileobj.write(data)
+        elif self.opener["append_mode"] in ["ab", "ab+"]:
+            self._fileobj.write(data.encode())
         elif self.opener["append_mode"] in ["a", "a+"]:
-            self._fileobj.write(line)
+            self._fileobj.write(data)
         else:
             raise NotImplementedError(f"Unsupported append mode")
 
+    def append(self, object: Union[dict, str, int, float, list, tuple]) -> None:
+        """Add an object to the file
+
+        Note:
+            - lines are buffered up to `write_buffer_size` characters, use
+              JSONL.flush to force them to disk (reading or closing also flushes)
+        """
+        line = self._serialize(object)
+        if line is None:
+            return
+        self._buffer_line(line)
+
     def extend(
         self, object_iterable: Iterable[Union[dict, str, int, float, list, tuple]]
     ) -> None:
-        """Appends each object in an iterable to the file (wraps JSONL.append)"""
-        self._assure_apendmode()
+        """Appends each object in an iterable to the file
+
+        Objects are serialized into the write buffer, which is written out with a
+        single call per `write_buffer_size` characters.
+        """
+        serialize = self._serialize
+        buffer_line = self._buffer_line
         for obj in object_iterable:
-            self.append(obj)
+            line = serialize(obj)
+            if line is None:
+                continue
+            buffer_line(line)
+
+    def _extend_index(self, lines: List[Union[str, bytes]]) -> None:
+        """Add the start offsets of lines about to be written to the line index"""
+        end = self._offsets[-1]
+        newline = len(self.line_end.encode())
+        offsets = []
+        for line in lines:
+            if type(line) == str and not line.isascii():
+                line = line.encode()
+            end += len(line) + newline
+            offsets.append(end)
+        self._offsets.extend(offsets)
+
+    def _load_index(self) -> bool:
+        """Load the line index from the sidecar file if it is up to date"""
+        if not os.path.exists(self.index_filename):
+            return False
+        offsets = array("Q")
+        with open(self.index_filename, "rb") as f:
+            offsets.frombytes(f.read())
+        if not offsets:
+            return False
+        if self.opener["object"] is open:
+            valid = offsets[-1] == os.path.getsize(self.filename)
+        else:
+            # uncompressed size is unknown without decompressing, rely on mtime
+            valid = os.path.getmtime(self.index_filename) >= os.path.getmtime(
+                self.filename
+            )
+        if valid:
+            self._offsets = offsets
+            self._offsets_saved = len(offsets)
+        return valid
+
+    def _build_index(self) -> None:
+        """Scan the file once to find the start offset of every line"""
+        offsets = array("Q", [0])
+        if self.opener["object"] is open:
+            with open(self.filename, mode="rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                if size:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        end = mm.find(b"\n")
+                        while end != -1:
+                            offsets.append(end + 1)
+                            end = mm.find(b"\n", end + 1)
+                    if offsets[-1] != size:
+                        offsets.append(size)
+            self._offsets = offsets
+            self._offsets_saved = 0
+            return
+        end = 0
+        with self.opener["object"](
+            self.filename, mode=self.opener["raw_read_mode"]
+        ) as f:
+            for line in f:
+                end += len(line)
+                offsets.append(end)
+        self._offsets = offsets
+        self._offsets_saved = 0
+
+    def _save_index(self) -> None:
+        """Write line offsets that are not yet in the sidecar file to disk"""
+        if not self.index or self._offsets is None:
+            return
+        if self._offsets_saved == len(self._offsets):
+            return
+        mode = "ab" if self._offsets_saved else "wb"
+        with open(self.index_filename, mode) as f:
+            self._offsets[self._offsets_saved :].tofile(f)
+        self._offsets_saved = len(self._offsets)
+
+    def _assure_index(self) -> None:
+        """Make sure the line index is available and covers all written lines"""
+        self._flush_buffer()
+        if self._mode == self.opener["append_mode"] and not self.closed():
+            # finish pending writes (and the gzip member) so they can be read back
+            self.open(for_read=True)
+            if self._index_fileobj is not None:
+                self._index_fileobj.close()
+        if self.opener.get("blocks"):
+            self._assure_block_index()
+            return
+        if self._offsets is None and not (self.index and self._load_index()):
+            self._build_index()
+            self._save_index()
+        if self._index_fileobj is None or self._index_fileobj.closed:
+            self._index_fileobj = self.opener["object"](
+                self.filename, mode=self.opener["raw_read_mode"]
+            )
+
+    def _assure_block_index(self) -> None:
+        """Read the headers of block-gzip members written since the last scan"""
+        if self._index_fileobj is None or self._index_fileobj.closed:
+            # blocks are read from the raw file and decompressed individually
+            self._index_fileobj = open(self.filename, mode="rb")
+        if not self._blocks_stale:
+            return
+        if not self._blocks:
+            self._blocks = []
+            self._block_starts = []
+            new_blocks = bgzf.read_block_index(self._index_fileobj)
+        else:
+            last = self._blocks[-1]
+            new_blocks = bgzf.read_block_index(
+                self._index_fileobj,
+                offset=last.offset + last.size,
+                first_line=last.first_line + last.n_lines,
+            )
+        self._blocks.extend(new_blocks)
+        self._block_starts.extend(block.first_line for block in new_blocks)
+        self._blocks_stale = False
+
+    def _n_lines(self) -> int:
+        """Number of indexed lines, assumes the index is up to date"""
+        if self._blocks is not None:
+            if not self._blocks:
+                return 0
+            return self._blocks[-1].first_line + self._blocks[-1].n_lines
+        return len(self._offsets) - 1
+
+    def _read_range(self, start: int, stop: int) -> bytes:
+        """Read the raw bytes of lines `start` up to (excluding) `stop`"""
+        begin = self._offsets[start]
+        self._index_fileobj.seek(begin)
+        return self._index_fileobj.read(self._offsets[stop] - begin)
+
+    def _read_block_range(self, start: int, stop: int) -> List[bytes]:
+        """Read lines `start` up to (excluding) `stop` from a block-gzip file"""
+        first = bisect_right(self._block_starts, start) - 1
+        last = bisect_right(self._block_starts, stop - 1) - 1
+        blocks = self._blocks[first : last + 1]
+        if len(blocks) == 1:
+            if self._block_cache is None or self._block_cache[0] != blocks[0]:
+                self._index_fileobj.seek(blocks[0].offset)
+                data = bgzf.decompress_block(self._index_fileobj.read(blocks[0].size))
+                self._block_cache = (blocks[0], data.splitlines())
+            lines = self._block_cache[1]
+        else:
+            lines = b"".join(bgzf.read_blocks(self._index_fileobj, blocks)).splitlines()
+        offset = start - blocks[0].first_line
+        return lines[offset : offset + stop - start]
+
+    def _read_lines(self, start: int, stop: int) -> List[bytes]:
+        """Read the raw lines `start` up to (excluding) `stop` using the index"""
+        if self._blocks is not None:
+            return self._read_block_range(start, stop)
+        return self._read_range(start, stop).splitlines()
+
+    def __bool__(self) -> bool:
+        # a JSONL is always truthy, without building the index like len() would
+        return True
+
+    def __len__(self) -> int:
+        """Number of lines in the file, uses (and if needed builds) the line index"""
+        self._assure_index()
+        return self._n_lines()
+
+    def __getitem__(
+        self, key: Union[int, slice]
+    ) -> Union[dict, str, int, float, list, tuple]:
+        """Random access to objects by line number (or slice of line numbers)
+
+        Note:
+            - the first access scans the file to build a line index, unless the
+              JSONL was opened with `index=True` and an up to date sidecar exists
+            - block-gzip files (.bgz) are indexed by their block headers, only
+              the blocks holding the requested lines are decompressed
+        """
+        self._assure_index()
+        n_lines = self._n_lines()
+        if isinstance(key, slice):
+            start, stop, step = key.indices(n_lines)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            if start >= stop:
+                return []
+            lines = self._read_lines(start, stop)
+            return [self.deserialize_line(line) for line in lines]
+        if key < 0:
+            key += n_lines
+        if not 0 <= key < n_lines:
+            raise IndexError("JSONL index out of range")
+        return self.deserialize_line(self._read_lines(key, key + 1)[0])
 
     def readline(self) -> Union[dict, str, int, float, list, tuple]:
         if self.closed():
@@ -149,6 +647,54 @@ class JSONL:
         self.n_read += 1
         return self.deserialize_line(line)
 
+    def _iter_objects(
+        self, query: _Query = None
+    ) -> Generator[Union[dict, str, int, float, list, tuple], None, None]:
+        """Yield deserialized objects from the file, assumes it is open for reading
+
+        Counts lines read in `n_read`, including those dropped by the `query`.
+        """
+        if self.use_mmap and self.opener["object"] is open:
+            lines = self._iter_mmap_lines()
+        else:
+            lines = self._fileobj
+        deserialize = self.deserialize_line
+        if query is None:
+            for line in lines:
+                self.n_read += 1
+                yield deserialize(line)
+            return
+        for line in lines:
+            self.n_read += 1
+            if not query.check_line(line):
+                continue
+            keep, obj = query.select(deserialize(line))
+            if keep:
+                yield obj
+
+    def _iter_mmap_lines(self) -> Generator[bytes, None, None]:
+        """Yield raw lines from a read-only memory map of the file
+
+        The map is split into newline-aligned chunks of about MMAP_CHUNK_SIZE bytes,
+        whose lines are handed to the parser as bytes, bypassing the text layer.
+        Finding lines per chunk keeps the per-line work in C.
+        """
+        with open(self.filename, mode="rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                start = 0
+                while start < size:
+                    end = mm.rfind(b"\n", start, start + MMAP_CHUNK_SIZE) + 1
+                    if start + MMAP_CHUNK_SIZE >= size:
+                        end = size
+                    elif end <= start:
+                        # a single line longer than a chunk
+                        end = mm.find(b"\n", start + MMAP_CHUNK_SIZE) + 1 or size
+                    yield from mm[start:end].splitlines()
+                    start = end
+
     def read(self) -> list:
         """Read all lines in a file and returns the contained objects as a list.
 
@@ -158,30 +704,248 @@ class JSONL:
         """
         self._assure_readmode()
         contents = []
-        for line in self._fileobj:
-            obj = self.deserialize_line(line)
+        for obj in self._iter_objects():
             contents.append(obj)
-            self.n_read += 1
             if len(contents) == 10000:
                 logging.warning(
-                    "Read 10000 lines into memory, consider using JSONL.stream "
+                    "Read 10000 lines into memory, consider using JSONL.stream, "
+                    "JSONL.iter_batches or JSONL.to_arrays "
                     "to avoid running out of memory."
                 )
         self.close()
         return contents
 
+    def _plan_shards(self, shard_size: int) -> List[Tuple[int, int]]:
+        """Split the file into byte ranges of roughly `shard_size` bytes
+
+        Plain files are split after a newline, block-gzip files between blocks.
+        """
+        if self.opener.get("blocks"):
+            self._assure_index()
+            shards = []
+            for block in self._blocks:
+                if shards and block.offset - shards[-1][0] < shard_size:
+                    shards[-1] = (shards[-1][0], block.offset + block.size)
+                else:
+                    shards.append((block.offset, block.offset + block.size))
+            return shards
+        size = os.path.getsize(self.filename)
+        boundaries = [0]
+        with open(self.filename, "rb") as f:
+            for position in range(shard_size, size, shard_size):
+                if position <= boundaries[-1]:
+                    continue
+                f.seek(position - 1)
+                f.readline()
+                boundaries.append(f.tell())
+        if boundaries[-1] < size:
+            boundaries.append(size)
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    def _stream_parallel(
+        self, n_workers: int, ordered: bool, shard_size: int, query: _Query = None
+    ) -> Generator[Union[dict, str, int, float, list, tuple], None, None]:
+        """Deserialize shards of the file in `n_workers` processes"""
+        compressed = bool(self.opener.get("blocks"))
+        # the query may hold lambdas, which the standard pickle can not handle
+        pickled_query = cloudpickle.dumps(query) if query is not None else None
+        shards = iter(self._plan_shards(shard_size))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+
+            def submit():
+                shard = next(shards, None)
+                if shard is None:
+                    return
+                return executor.submit(
+                    _parse_shard,
+                    self.filename,
+                    *shard,
+                    compressed,
+                    self.skip_unserializable_objects,
+                    self.json_backend.name,
+                    pickled_query,
+                )
+
+            # keep a bounded number of shards in flight to bound memory use
+            pending = deque()
+            for _ in range(2 * n_workers):
+                future = submit()
+                if future:
+                    pending.append(future)
+            while pending:
+                if ordered:
+                    done = [pending.popleft()]
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                for future in done:
+                    n_lines, objects = future.result()
+                    self.n_read += n_lines
+                    yield from objects
+                    future = submit()
+                    if future:
+                        pending.append(future)
+
     def stream(
         self,
+        n_workers: int = None,
+        ordered: bool = True,
+        shard_size: int = SHARD_SIZE,
+        fields: Sequence[Union[str, tuple]] = None,
+        where: Callable = None,
+        contains: Union[str, bytes, Sequence[Union[str, bytes]]] = None,
     ) -> Generator[Union[dict, str, int, float, list, tuple], None, None]:
         """Yield objects from file one-by-one
 
+        Parameters
+        ---
+        n_workers : int (default None)
+            Deserialize the file in parallel, using this many processes. The file is
+            split into newline-aligned shards of about `shard_size` bytes (or whole
+            blocks for block-gzip files). Monolithic gzip files can not be split and
+            are always read in a single process.
+        ordered : bool (default True)
+            When reading in parallel, yield objects in file order. Otherwise, objects
+            are yielded shard by shard as soon as a shard is done.
+        shard_size : int
+            Approximate size in bytes (on disk) of a shard when reading in parallel
+        fields : list (default None)
+            Key paths to keep, either dotted strings ("user.name", list positions
+            as numbers: "links.0") or tuples of keys. Objects are yielded as dicts
+            mapping each field to its value, or None if the path does not exist.
+        where : Callable (default None)
+            Only yield objects for which `where(obj)` is true. Called on the full
+            object, before the projection to `fields`.
+        contains : str, bytes or list (default None)
+            Skip lines that do not contain (all of) these substrings, without
+            parsing them. A cheap pre-filter; the text is matched against the raw
+            JSON, so use it alongside an exact `where`.
+
         Note:
+            - reads uncompressed files through a memory map if `use_mmap` is set
+            - `n_read` counts lines read, including those dropped by `where` or
+              `contains`
             - re-opens file if file is closed
             - closes file after reading (as the end of the buffer is reached)
         """
         self._assure_readmode()
-        for line in self._fileobj:
-            obj = self.deserialize_line(line)
-            self.n_read += 1
-            yield obj
+        query = None
+        if fields is not None or where is not None or contains:
+            query = _Query(fields, where, contains)
+        if n_workers and n_workers > 1:
+            if self.opener["object"] is open or self.opener.get("blocks"):
+                yield from self._stream_parallel(n_workers, ordered, shard_size, query)
+                self.close()
+                return
+            logging.warning(
+                f"Can not split {self.filename} for parallel reading, "
+                "use a block-gzip (.bgz) file instead. Reading in a single process."
+            )
+        yield from self._iter_objects(query)
         self.close()
+
+    def iter_batches(
+        self, size: int = 10000, **kwargs
+    ) -> Generator[List[Union[dict, str, int, float, list, tuple]], None, None]:
+        """Yield objects from file in lists of (at most) `size` objects
+
+        Keyword arguments are passed on to JSONL.stream.
+        """
+        batch = []
+        for obj in self.stream(**kwargs):
+            batch.append(obj)
+            if len(batch) == size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _iter_column_batches(
+        self, fields: Sequence[Union[str, tuple]], batch_size: int, **kwargs
+    ) -> Generator[Dict[Union[str, tuple], list], None, None]:
+        """Yield batches of objects as a dict of column name to list of values
+
+        Without `fields`, the columns are the top-level keys in the first batch.
+        Lines that are not objects count as missing values in every column.
+        """
+        for batch in self.iter_batches(batch_size, fields=fields, **kwargs):
+            batch = [obj if type(obj) is dict else {} for obj in batch]
+            if fields is None:
+                # later batches are parsed whole, the columns are picked below
+                fields = list({key: None for obj in batch for key in obj})
+            yield {field: [obj.get(field) for obj in batch] for field in fields}
+
+    def to_arrays(
+        self,
+        fields: Sequence[Union[str, tuple]] = None,
+        dtypes: dict = None,
+        schema: dict = None,
+        batch_size: int = 10000,
+        **kwargs,
+    ) -> dict:
+        """Read (fields of) the objects in the file into a dict of NumPy arrays
+
+        Columns are converted to arrays batch by batch, so the file is never held
+        in memory as a list of objects.
+
+        Parameters
+        ---
+        fields : list (default None)
+            Key paths to read, as in JSONL.stream. Defaults to the top-level keys
+            of the objects in the first batch.
+        dtypes : dict (default None)
+            NumPy dtype per field. Fields without a dtype have it inferred.
+        schema : dict (default None)
+            A (nested) schema of python types, as produced by
+            `bobtools.datascan.DictScanner.to_schema`, used to pick dtypes for
+            fields not in `dtypes`.
+        batch_size : int
+            Number of objects converted at a time
+
+        Other keyword arguments are passed on to JSONL.stream.
+        """
+        import numpy as np
+
+        dtypes = {**_flatten_schema(schema or {}), **(dtypes or {})}
+        chunks = {}
+        for columns in self._iter_column_batches(fields, batch_size, **kwargs):
+            for field, values in columns.items():
+                array = _column_to_array(values, dtypes.get(field))
+                chunks.setdefault(field, []).append(array)
+        return {field: np.concatenate(arrays) for field, arrays in chunks.items()}
+
+    def to_dataframe(self, fields: Sequence[Union[str, tuple]] = None, **kwargs):
+        """Read (fields of) the objects in the file into a pandas DataFrame
+
+        Takes the same arguments as JSONL.to_arrays.
+        """
+        import pandas as pd
+
+        arrays = self.to_arrays(fields, **kwargs)
+        return pd.DataFrame(arrays, columns=list(arrays))
+
+    def to_arrow(
+        self,
+        fields: Sequence[Union[str, tuple]] = None,
+        batch_size: int = 10000,
+        **kwargs,
+    ):
+        """Read (fields of) the objects in the file into a pyarrow Table
+
+        Requires pyarrow. Arrow types are inferred per batch and promoted where
+        batches differ. Other keyword arguments are passed on to JSONL.stream.
+        """
+        import pyarrow as pa
+
+        tables = [
+            pa.table({str(field): values for field, values in columns.items()})
+            for columns in self._iter_column_batches(fields, batch_size, **kwargs)
+        ]
+        if not tables:
+            return pa.table({})
+        try:
+            return pa.concat_tables(tables, promote_options="default")
+        except TypeError:
+            # pyarrow < 14
+            return pa.concat_tables(tables, promote=True)
@@ -0,0 +1,163 @@
+import gzip
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Union
+
+from bobtools.io.jsonl import JSONL
+
+MANIFEST_EXTENSION = "manifest.json"
+
+
+def _compress_file(filename: str, compresslevel: int) -> str:
+    """Gzip a file next to the original, remove the original and return the new name"""
+    compressed = f"{filename}.gz"
+    with open(filename, "rb") as source:
+        with gzip.open(compressed, "wb", compresslevel=compresslevel) as target:
+            shutil.copyfileobj(source, target)
+    os.remove(filename)
+    return compressed
+
+
+class ShardedJSONL:
+    """Write objects to a series of JSONL shards
+
+    A new shard, named `{basename}-{number:05d}.{extension}`, is started when the
+    current one holds `max_records` objects or `max_bytes` (uncompressed) bytes.
+    With `compress=True`, finished shards are gzipped on a background thread.
+    A manifest (`{basename}.manifest.json`) lists the finished shards with their
+    number of records, so readers can process shards in parallel.
+
+    Other keyword arguments are passed on to JSONL.
+    """
+
+    def __init__(
+        self,
+        basename: str,
+        extension: str = "jsonl",
+        max_records: int = None,
+        max_bytes: int = None,
+        compress: bool = False,
+        compresslevel: int = 6,
+        manifest: bool = True,
+        **kwargs,
+    ):
+        if not max_records and not max_bytes:
+            raise ValueError("Set `max_records` and/or `max_bytes` to limit shards")
+        self.basename = basename
+        self.extension = extension
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.compresslevel = compresslevel
+        self.manifest = manifest
+        self.manifest_filename = f"{basename}.{MANIFEST_EXTENSION}"
+        self.jsonl_kwargs = kwargs
+        self.written = 0
+        self.shards = []
+        self._current = None
+        self._compressor = ThreadPoolExecutor(max_workers=1) if compress else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type=None, value=None, traceback=None):
+        self.close()
+
+    def _open_shard(self) -> None:
+        filename = f"{self.basename}-{len(self.shards):05d}.{self.extension}"
+        for existing in [filename, f"{filename}.gz"] if self.compress else [filename]:
+            if os.path.exists(existing):
+                raise FileExistsError(f"Shard {existing} already exists")
+        self._current = JSONL(filename, **self.jsonl_kwargs)
+
+    def _close_shard(self) -> None:
+        """Close the current shard, queue it for compression and update the manifest"""
+        shard, self._current = self._current, None
+        shard.close()
+        entry = {
+            "filename": shard.filename,
+            "records": shard.written,
+            "bytes": shard.bytes_written,
+        }
+        if self._compressor is not None:
+            entry["future"] = self._compressor.submit(
+                _compress_file, shard.filename, self.compresslevel
+            )
+        self.shards.append(entry)
+        self._write_manifest()
+
+    def _finished_shards(self, wait: bool = False) -> List[dict]:
+        """Shards that are closed (and compressed, if so configured)"""
+        finished = []
+        for entry in self.shards:
+            future = entry.get("future")
+            if future is not None:
+                if not (wait or future.done()):
+                    continue
+                entry["filename"] = future.result()
+                del entry["future"]
+            finished.append(entry)
+        return finished
+
+    def _write_manifest(self, wait: bool = False) -> None:
+        if not self.manifest:
+            return
+        directory = os.path.dirname(self.manifest_filename)
+        shards = [
+            {**entry, "filename": os.path.relpath(entry["filename"], directory or ".")}
+            for entry in self._finished_shards(wait)
+        ]
+        manifest = {
+            "shards": shards,
+            "records": sum(shard["records"] for shard in shards),
+        }
+        with open(self.manifest_filename, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def append(self, object: Union[dict, str, int, float, list, tuple]) -> None:
+        """Add an object to the current shard, starting a new one when it is full"""
+        if self._current is None:
+            self._open_shard()
+        before = self._current.written
+        self._current.append(object)
+        self.written += self._current.written - before
+        if (self.max_records and self._current.written >= self.max_records) or (
+            self.max_bytes and self._current.bytes_written >= self.max_bytes
+        ):
+            self._close_shard()
+
+    def extend(
+        self, object_iterable: Iterable[Union[dict, str, int, float, list, tuple]]
+    ) -> None:
+        """Appends each object in an iterable to the shards"""
+        for obj in object_iterable:
+            self.append(obj)
+
+    def close(self) -> None:
+        """Close the last shard and wait for compression to finish"""
+        if self._current is not None:
+            if self._current.written:
+                self._close_shard()
+            else:
+                # all objects were skipped as unserializable
+                self._current.close()
+                os.remove(self._current.filename)
+                self._current = None
+        if self._compressor is not None:
+            self._compressor.shutdown(wait=True)
+        if self.shards or not os.path.exists(self.manifest_filename):
+            # don't replace the manifest of an earlier run with an empty one
+            self._write_manifest(wait=True)
+
+    @staticmethod
+    def read_manifest(manifest_filename: str) -> List[dict]:
+        """Return the shards listed in a manifest, with paths relative to cwd"""
+        with open(manifest_filename) as f:
+            manifest = json.load(f)
+        directory = os.path.dirname(manifest_filename)
+        return [
+            {**shard, "filename": os.path.join(directory, shard["filename"])}
+            for shard in manifest["shards"]
+        ]
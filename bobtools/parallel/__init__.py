@@ -1,3 +1,4 @@
-from bobtools.parallel._funnel import funnel
+from bobtools.parallel._funnel import Funnel, funnel
+from bobtools.parallel._pipeline import Pipeline
 
-__all__ = [funnel]
+__all__ = [funnel, Funnel, Pipeline]
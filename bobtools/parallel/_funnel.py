@@ -1,77 +1,1234 @@
+import asyncio
+import inspect
+import itertools
 import logging
 import multiprocessing
+import os
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
 
 import cloudpickle
 
+from bobtools.parallel._metrics import METRICS_INTERVAL, Metrics, WorkerMetrics
+from bobtools.parallel._shm import SHM_BLOCK_SIZE, SHM_THRESHOLD, BlockPool
 
-class _MultiWorker(multiprocessing.Process):
-    def __init__(self, task_queue, results_queue, func):
-        multiprocessing.Process.__init__(self)
+# adaptive chunking aims for chunks that take about this long (in seconds) to process
+TARGET_CHUNK_TIME = 0.01
+MAX_CHUNKSIZE = 10000
+# how often (in seconds) blocked waits wake up to check on the workers
+POLL_INTERVAL = 0.1
+# how often (in seconds) the number of multi-workers is reconsidered, and how
+# many times in a row the task queue has to be empty to retire one
+SCALE_INTERVAL = 0.5
+SCALE_DOWN_CHECKS = 3
+
+
+def _call(func, task):
+    """Call func on a task, unpacking tuples as *args and dicts as **kwargs"""
+    if type(task) == dict:
+        return func(**task)
+    elif type(task) == tuple:
+        return func(*task)
+    else:
+        return func(task)
+
+
+class _Stopped(Exception):
+    """Raised inside a worker when its pool is being stopped"""
+
+
+class _Failure(NamedTuple):
+    """A task that kept failing, sent on in place of its result"""
+
+    task: object
+    error: Exception
+
+
+def _split_failures(results):
+    """Separate the _Failures from the results of a chunk"""
+    failures = [result for result in results if type(result) is _Failure]
+    if failures:
+        results = [result for result in results if type(result) is not _Failure]
+    return results, failures
+
+
+class _Worker:
+    """Worker loop that runs in a process or a thread, depending on the backend"""
+
+    def __init__(
+        self,
+        name,
+        task_queue,
+        results_queue,
+        control_queue,
+        stop_event,
+        pickled,
+        shm=None,
+        metrics=None,
+        retries=0,
+        slot=None,
+    ):
+        self.name = name
         self.task_queue = task_queue
         self.results_queue = results_queue
-        self.func = cloudpickle.loads(func)
+        # functions (and settings) are shipped on the control queue
+        self.control_queue = control_queue
+        # set when the pool stops, for threads that cannot be terminated
+        self.stop_event = stop_event
+        # functions are cloudpickled for processes, and passed as-is to threads
+        self.pickled = pickled
+        # pool of shared memory blocks for large payloads, if enabled
+        self.shm = shm
+        # counters reported to the parent, if it listens
+        self.metrics = metrics or WorkerMetrics(name, None)
+        # times a failing task is retried before it is given up on
+        self.retries = retries
+        # shared (chunk seq, task index, task start time) of the current task,
+        # so the parent can spot hung tasks and resubmit the work of dead workers
+        self.slot = slot
+        self.func = None
         logging.info(f"{self.name} : Started")
 
+    def _load(self, func):
+        return cloudpickle.loads(func) if self.pickled else func
+
+    def _encode(self, results):
+        if self.shm is None:
+            return results
+        return [self.shm.encode(result) for result in results]
+
+    def _decode(self, results):
+        if self.shm is None:
+            return results
+        return [self.shm.decode(result) for result in results]
+
+    def _release(self, results):
+        """Free the shared memory blocks of results that are dropped"""
+        if self.shm is None:
+            return
+        for result in results:
+            self.shm.release(result)
+
+    def _get(self, q):
+        start = time.perf_counter()
+        try:
+            while True:
+                try:
+                    return q.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    if self.stop_event.is_set():
+                        raise _Stopped()
+                    self.metrics.report()
+        finally:
+            self.metrics.idle += time.perf_counter() - start
+
+    def _put(self, q, item):
+        start = time.perf_counter()
+        try:
+            while True:
+                try:
+                    return q.put(item, timeout=POLL_INTERVAL)
+                except queue.Full:
+                    if self.stop_event.is_set():
+                        raise _Stopped()
+                    self.metrics.report()
+        finally:
+            self.metrics.blocked += time.perf_counter() - start
+
+    def _failure(self, task, error):
+        self.metrics.failed += 1
+        logging.warning(
+            f"{self.name} gave up on a task after {self.retries + 1} attempts: {error!r}"
+        )
+        if self.pickled:
+            # the error has to make it to the parent
+            try:
+                cloudpickle.dumps(error)
+            except Exception:
+                error = RuntimeError(f"{type(error).__name__}: {error}")
+        return _Failure(task, error)
+
+    def _attempt(self, task):
+        """Call the function on a task, returning a _Failure once retries run out"""
+        for attempt in range(self.retries + 1):
+            try:
+                return _call(self.func, task)
+            except Exception as e:
+                error = e
+                if attempt < self.retries:
+                    self.metrics.retries += 1
+        return self._failure(task, error)
+
+    def _chunk_done(self, start, n_tasks):
+        """Record a processed chunk, tasks get the average latency of the chunk"""
+        elapsed = time.perf_counter() - start
+        self.metrics.chunks += 1
+        self.metrics.busy += elapsed
+        if n_tasks:
+            self.metrics.task(elapsed / n_tasks, n_tasks)
+        self.metrics.report()
+
     def run(self):
-        proc_name = self.name
+        try:
+            self._run()
+        except _Stopped:
+            pass
+        self.metrics.report(force=True)
+        logging.info(f"{self.name} is exiting")
+
+    def _run(self):
+        raise NotImplementedError()
+
+
+class _MultiWorker(_Worker):
+    def __init__(
+        self, *args, task_time=None, output_queue=None, n_taken=None, run_id=None
+    ):
+        _Worker.__init__(self, *args)
+        self.func_id = None
+        # shared id of the current run, chunks of earlier runs are dropped
+        self.run_id = run_id
+        # shared moving average of the time per task, used for adaptive chunking
+        self.task_time = task_time
+        # shared number of items taken from the task queue, which tells the
+        # parent which chunks are still waiting in it
+        self.n_taken = n_taken
+        # without a single_func, results skip the single-worker
+        self.output_queue = output_queue
+        self.passthrough = False
+
+    def _load_func(self, run_id, func_id):
+        """Load the function of a chunk, False if the chunk is of a run that is over
+
+        Chunks resubmitted after a crash can outlive their run in the task queue.
+        """
+        if self.run_id is not None and run_id < self.run_id.value:
+            return False
+        while self.func_id is None or self.func_id < func_id:
+            self.func_id, func, self.passthrough = self._get(self.control_queue)
+            self.func = self._load(func)
+        return self.func_id == func_id
+
+    def _send(self, run_id, seq, results):
+        if self.passthrough:
+            # in the form the single-worker sends them, failures and all
+            self._put(self.output_queue, (run_id, seq, results, None))
+        else:
+            self._put(self.results_queue, (run_id, seq, results))
+
+    def _update_task_time(self, start, n_tasks):
+        if self.task_time is None or not n_tasks:
+            return
+        elapsed = (time.perf_counter() - start) / n_tasks
+        with self.task_time.get_lock():
+            if self.task_time.value:
+                elapsed = 0.8 * self.task_time.value + 0.2 * elapsed
+            self.task_time.value = elapsed
+
+    def _take(self):
+        item = self._get(self.task_queue)
+        if self.n_taken is not None:
+            with self.n_taken.get_lock():
+                self.n_taken.value += 1
+        return item
+
+    def _run(self):
         while True:
-            task = self.task_queue.get()
-            if task is None:
-                logging.info(f"{proc_name} is exiting")
+            item = self._take()
+            if item is None:
                 self.task_queue.task_done()
                 break
-            logging.info(
-                f"{proc_name}-{self.func.__name__} called on {task} (type: {type(task)})"
-            )
-            if type(task) == dict:
-                result = self.func(**task)
-            elif type(task) == tuple:
-                result = self.func(*task)
-            else:
-                result = self.func(task)
-            self.results_queue.put(result)
+            run_id, func_id, seq, chunk = item
+            if not self._load_func(run_id, func_id):
+                self.task_queue.task_done()
+                continue
+            slot = self.slot
+            slot[0] = seq
+            start = time.perf_counter()
+            results = []
+            for index, task in enumerate(chunk):
+                slot[1], slot[2] = index, time.time()
+                results.append(self._attempt(task))
+            slot[2] = 0.0
+            # a worker that was replaced for taking too long sends nothing
+            if self.stop_event.is_set():
+                raise _Stopped()
+            self._update_task_time(start, len(chunk))
+            self._chunk_done(start, len(chunk))
+            self._send(run_id, seq, self._encode(results))
+            slot[0] = -1
             self.task_queue.task_done()
-        return
 
 
-class _SingleWorker(multiprocessing.Process):
-    def __init__(self, task_queue, result_queue, func):
-        multiprocessing.Process.__init__(self)
-        self.task_queue = task_queue
-        self.result_queue = result_queue
-        self.func = cloudpickle.loads(func) if func else None
-        self.stop = False
-        logging.info(f"{self.name} : Started")
+class _AsyncioMultiWorker(_MultiWorker):
+    """Multi-worker that runs the multi_func concurrently on an event loop
 
-    def run(self):
-        while True:
-            task = self.task_queue.get()
-            if task is None or self.stop:
-                if self.task_queue.empty():
-                    logging.info(f"{self.name} is exiting")
-                    self.task_queue.task_done()
-                    self.result_queue.put(None)
+    Coroutine functions are awaited, `concurrency` limits the number of tasks
+    in flight. The (blocking) queues are accessed from a thread pool.
+    """
+
+    def __init__(
+        self,
+        *args,
+        task_time=None,
+        output_queue=None,
+        run_id=None,
+        concurrency=1,
+        task_timeout=None,
+    ):
+        _MultiWorker.__init__(
+            self, *args, task_time=task_time, output_queue=output_queue, run_id=run_id
+        )
+        self.concurrency = concurrency
+        # coroutines taking longer than this are cancelled and count as failed
+        self.task_timeout = task_timeout
+
+    def _run(self):
+        # one thread waits for tasks, the others hand over results
+        executor = ThreadPoolExecutor(max_workers=self.concurrency + 1)
+        try:
+            asyncio.run(self._main(executor))
+        finally:
+            # a thread waiting for tasks only stops with the pool
+            executor.shutdown(wait=False)
+
+    async def _call(self, semaphore, task):
+        async with semaphore:
+            start = time.perf_counter()
+            for attempt in range(self.retries + 1):
+                try:
+                    result = _call(self.func, task)
+                    if inspect.isawaitable(result):
+                        result = await asyncio.wait_for(result, self.task_timeout)
                     break
-                self.stop = True
-                continue
-            logging.info(f"{self.name} called on {task}")
+                except Exception as e:
+                    error = e
+                    if attempt < self.retries:
+                        self.metrics.retries += 1
+            else:
+                result = self._failure(task, error)
+            self.metrics.task(time.perf_counter() - start)
+            return result
+
+    async def _process(self, executor, semaphore, item):
+        run_id, func_id, seq, chunk = item
+        start = time.perf_counter()
+        results = await asyncio.gather(*[self._call(semaphore, task) for task in chunk])
+        self._update_task_time(start, len(chunk))
+        # chunks overlap, so busy time can add up to more than the wall time, the
+        # latency of each task is recorded separately
+        self._chunk_done(start, 0)
+        await asyncio.get_running_loop().run_in_executor(
+            executor, self._send, run_id, seq, results
+        )
+        self.task_queue.task_done()
+
+    async def _main(self, executor):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # limit the chunks in flight as well, to keep backpressure on the parent
+        chunk_slots = asyncio.Semaphore(self.concurrency)
+        pending = set()
+        # a chunk failing outside of the tasks ends the worker
+        failed = loop.create_future()
+
+        def done(future):
+            pending.discard(future)
+            chunk_slots.release()
+            if future.cancelled() or failed.done():
+                return
+            if future.exception() is not None:
+                failed.set_exception(future.exception())
+
+        async def wait_for(awaitable):
+            future = asyncio.ensure_future(awaitable)
+            await asyncio.wait([future, failed], return_when=asyncio.FIRST_COMPLETED)
+            if failed.done():
+                future.cancel()
+                failed.result()
+            return future.result()
 
-            if not self.func:
-                self.result_queue.put(task)
+        while True:
+            await wait_for(chunk_slots.acquire())
+            item = await wait_for(
+                loop.run_in_executor(executor, self._get, self.task_queue)
+            )
+            if item is None:
+                break
+            if not self._load_func(item[0], item[1]):
+                chunk_slots.release()
                 self.task_queue.task_done()
                 continue
+            future = asyncio.ensure_future(self._process(executor, semaphore, item))
+            pending.add(future)
+            future.add_done_callback(done)
+        while pending:
+            await wait_for(asyncio.wait(pending))
+        self.task_queue.task_done()
+
+
+class _SingleWorker(_Worker):
+    def __init__(self, *args):
+        _Worker.__init__(self, *args)
+        self.run_id = None
+        self.ordered = False
 
-            elif type(task) == dict:
-                result = self.func(**task)
-            elif type(task) == tuple:
-                result = self.func(*task)
+    def _start_run(self, run_id):
+        # runs without any tasks never reach this worker, skip past them
+        while self.run_id != run_id:
+            self.run_id, self.ordered, changed, func = self._get(self.control_queue)
+            if changed:
+                self.func = self._load(func)
+
+    def _run(self):
+        # results that arrived ahead of their turn, by sequence number
+        reorder_buffer = {}
+        next_seq = 0
+        # chunks processed in this run, without `ordered`
+        done = set()
+        while True:
+            item = self._get(self.task_queue)
+            if item is None:
+                self.task_queue.task_done()
+                break
+            run_id, seq, chunk = item
+            if self.run_id is not None and run_id < self.run_id:
+                # a resubmitted chunk of a run that is over
+                self._release(chunk)
+                self.task_queue.task_done()
+                continue
+            if run_id != self.run_id:
+                self._start_run(run_id)
+                for buffered in reorder_buffer.values():
+                    self._release(buffered)
+                reorder_buffer = {}
+                next_seq = 0
+                done = set()
+            # a chunk can arrive twice when it was resubmitted, the single_func
+            # only sees it once
+            if not self.ordered:
+                if seq in done:
+                    self._release(chunk)
+                else:
+                    done.add(seq)
+                    self._process(seq, chunk)
+            elif seq < next_seq or seq in reorder_buffer:
+                self._release(chunk)
             else:
-                result = self.func(task)
-            # if the function returns a result, put it in the output_queue
-            if not isinstance(result, type(None)):
-                self.result_queue.put(result)
+                reorder_buffer[seq] = chunk
+                while next_seq in reorder_buffer:
+                    self._process(next_seq, reorder_buffer.pop(next_seq))
+                    next_seq += 1
             self.task_queue.task_done()
-        return
+
+    def _process(self, seq, chunk):
+        """Process a chunk, always sending its run, seq, results and failures
+
+        The parent counts the chunks to know when a run is done.
+        """
+        start = time.perf_counter()
+        results, failures = [], []
+        # if the function returns a result, put it in the output_queue
+        for task in self._decode(chunk):
+            if type(task) is _Failure:
+                failures.append(task)
+                continue
+            result = self._attempt(task)
+            if type(result) is _Failure:
+                failures.append(result)
+            elif not isinstance(result, type(None)):
+                results.append(result)
+        self._chunk_done(start, len(chunk))
+        self._put(
+            self.results_queue,
+            (self.run_id, seq, self._encode(results), failures or None),
+        )
+
+
+class _Thread(threading.Thread):
+    """Thread with the parts of the multiprocessing.Process interface funnel uses"""
+
+    def __init__(self, target, name=None):
+        threading.Thread.__init__(self, target=target, name=name, daemon=True)
+        self.exitcode = None
+
+    def run(self):
+        try:
+            threading.Thread.run(self)
+        except BaseException:
+            logging.exception(f"{self.name} failed")
+            self.exitcode = 1
+            return
+        self.exitcode = 0
+
+    def terminate(self):
+        # threads can't be killed, they exit once the pool's stop event is set
+        pass
+
+
+BACKENDS = ("process", "thread", "asyncio")
+
+
+def _chunks(iterable, chunksize, task_time=None):
+    """Group items from an iterable into lists
+
+    With a `task_time`, the size of each chunk is chosen so that it takes about
+    TARGET_CHUNK_TIME seconds to process, based on the measured time per task.
+    """
+    iterator = iter(iterable)
+    while True:
+        if task_time is not None:
+            if task_time.value:
+                chunksize = int(TARGET_CHUNK_TIME / task_time.value)
+            chunksize = max(1, min(chunksize, MAX_CHUNKSIZE))
+        chunk = list(itertools.islice(iterator, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+class _Watchdog:
+    """Keeps track of progress and the health of workers while funnel waits"""
+
+    def __init__(self, workers, timeout=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.last_progress = time.monotonic()
+
+    def progress(self):
+        self.last_progress = time.monotonic()
+
+    def check(self):
+        """Raise if a worker died, or nothing happened for `timeout` seconds"""
+        for worker in self.workers:
+            if worker.exitcode:
+                raise RuntimeError(
+                    f"{worker.name} exited unexpectedly (exit code {worker.exitcode})"
+                )
+        if self.timeout is not None:
+            if time.monotonic() - self.last_progress > self.timeout:
+                raise TimeoutError(f"No progress in funnel for {self.timeout} seconds")
+
+
+def _debug_enabled() -> bool:
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+def _cpu_available() -> bool:
+    """Whether the machine has a core to spare, judging by the load average"""
+    try:
+        load = os.getloadavg()[0]
+    except (AttributeError, OSError):
+        # not available on Windows
+        return True
+    if hasattr(os, "sched_getaffinity"):
+        n_cpus = len(os.sched_getaffinity(0))
+    else:
+        n_cpus = os.cpu_count() or 1
+    return load + 1 <= n_cpus
+
+
+class _WorkerHandle(NamedTuple):
+    """A worker as the parent sees it"""
+
+    process: object
+    stop_event: object
+    control_queue: object = None
+    # current task of a multi-worker, see _Worker
+    slot: object = None
+
+
+def _terminate(workers, shm=None):
+    # the list is updated in place when workers come and go
+    for w in workers:
+        w.stop_event.set()
+    for w in workers:
+        w.process.terminate()
+    if shm is not None:
+        shm.close()
+
+
+class Funnel:
+    """Pool of funnel workers that stays alive across runs
+
+    Starting processes and shipping functions to them dominates the run time
+    of `funnel` on small inputs. A Funnel keeps its multi-workers and
+    single-worker alive between calls to `run`, and only sends functions to
+    them when they change. Use it as a context manager, or call `close` when done.
+
+    Parameters
+    ---
+    n_workers : int or tuple of 2 ints (default 3)
+        Number of workers, one of which applies the single_func while the
+        others apply the multi_func. Without a single_func, results are passed
+        through by the parent and no single-worker is needed. With a (min, max)
+        tuple, the number of multi-workers scales with the load: a worker is
+        added while tasks pile up in the task queue (and, for processes, the
+        load average leaves a core to spare), and one is retired when the task
+        queue stays empty. Scaling keeps within min and max workers in total,
+        and with a fixed number, a pass-through run may use the slot of the
+        single-worker for an extra multi-worker.
+    concurrent_tasks : tuple of 3 ints (default (100, 100, 100))
+        Maximum size of the task, intermediate result and output queues
+    backend : str (default "process")
+        Where the workers run. "process" uses a process per worker. "thread"
+        uses threads, which suits I/O-bound functions and avoids pickling them.
+        "asyncio" runs the multi_func on an event loop in a thread, awaiting
+        coroutine functions, with at most n_workers - 1 (the maximum) tasks in
+        flight; blocking functions would stall the loop, use "thread" for those.
+    shared_memory : bool (default False)
+        With the process backend, move NumPy arrays and bytes of at least
+        `shm_threshold` bytes between processes through shared memory instead of
+        pickling them through the queues. Payloads are recognised as whole
+        results, or as items of a result tuple, list or dict. Needs Python 3.8
+        or later.
+    shm_threshold : int (default SHM_THRESHOLD)
+        Minimum size in bytes of payloads moved through shared memory
+    shm_block_size : int (default SHM_BLOCK_SIZE)
+        Size of each shared memory block, larger payloads are pickled
+    shm_blocks : int (default None)
+        Number of blocks in the pool, 4 * n_workers (the maximum) by default.
+        Payloads are pickled when all blocks are in use.
+    on_metrics : Callable (default None)
+        Called with a snapshot of the metrics (see `metrics`) every
+        `metrics_interval` seconds during a run, and at the end of every run
+    metrics_interval : float (default METRICS_INTERVAL)
+        How often, in seconds, workers report their metrics to the parent
+    retries : int (default 0)
+        Number of times a task that raises an exception is retried, by the same
+        worker, before it fails
+    task_timeout : float (default None)
+        Maximum time in seconds a single multi_func task may take. A multi-worker
+        stuck on a task for longer is terminated and replaced; with "asyncio"
+        the coroutine is cancelled instead.
+    dead_letter : Callable (default None)
+        Called in the parent as dead_letter(task, error) for every task that
+        failed, timed out or crashed its worker, after which the run continues.
+        Without it, the error is raised from the run.
+
+    When a multi-worker dies or is replaced, the task it was running goes to
+    `dead_letter`, and the chunks that are not done yet are sent again to the
+    workers (with processes all chunks that were taken from the task queue, as
+    results can die with the process). The multi_func may see a task twice,
+    the single_func sees every result once and every result is yielded once.
+
+    Example
+    ---
+    with Funnel(n_workers=(2, 8)) as pool:
+        for batch in batches:
+            results = list(pool.run(batch, download, store))
+    """
+
+    def __init__(
+        self,
+        n_workers=3,
+        concurrent_tasks=(100, 100, 100),
+        backend="process",
+        shared_memory=False,
+        shm_threshold=SHM_THRESHOLD,
+        shm_block_size=SHM_BLOCK_SIZE,
+        shm_blocks=None,
+        on_metrics=None,
+        metrics_interval=METRICS_INTERVAL,
+        retries=0,
+        task_timeout=None,
+        dead_letter=None,
+    ):
+        min_workers, max_workers = (
+            n_workers if type(n_workers) is tuple else (n_workers, n_workers)
+        )
+        # Sanity check
+        if min_workers < 2:
+            raise ValueError(
+                "`n_workers` should be 2 or higher; "
+                "At least 1 multi-worker and 1 single-worker is needed."
+            )
+        if max_workers < min_workers:
+            raise ValueError("The maximum of `n_workers` is below its minimum")
+        if backend not in BACKENDS:
+            raise ValueError(
+                f"Unknown backend {backend}, choose from {', '.join(BACKENDS)}"
+            )
+        self.n_workers = n_workers
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.concurrent_tasks = concurrent_tasks
+        self.backend = backend
+        # threads share memory already
+        self.shared_memory = shared_memory and backend == "process"
+        self.shm_threshold = shm_threshold
+        self.shm_block_size = shm_block_size
+        self.shm_blocks = shm_blocks or 4 * max_workers
+        self.on_metrics = on_metrics
+        self.metrics_interval = metrics_interval
+        self.retries = retries
+        self.task_timeout = task_timeout
+        self.dead_letter = dead_letter
+        self._metrics = None
+        # all workers, and the multi-workers and single-worker among them
+        self._workers = []
+        self._multi_workers = []
+        self._single_worker = None
+        self._running = False
+        self._run_id = 0
+        # whether the current run has a single_func, otherwise the multi-workers
+        # send their results straight to the parent
+        self._single_stage = False
+        # (pickled) functions the workers have, to ship new ones only on change
+        self._func_id = 0
+        self._multi_func = None
+        self._passthrough = False
+        self._single_func = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type=None, value=None, traceback=None):
+        self.close()
+
+    @property
+    def started(self) -> bool:
+        return bool(self._workers)
+
+    def _start(self):
+        if self.backend == "process":
+            Worker, JoinableQueue, Queue, Event = (
+                multiprocessing.Process,
+                multiprocessing.JoinableQueue,
+                multiprocessing.Queue,
+                multiprocessing.Event,
+            )
+        else:
+            Worker, JoinableQueue, Queue, Event = (
+                _Thread,
+                queue.Queue,
+                queue.Queue,
+                threading.Event,
+            )
+        # kept around to start workers later on
+        self._Worker, self._Queue, self._Event = Worker, Queue, Event
+
+        # set up queues
+        self._multi_func_queue = JoinableQueue(maxsize=self.concurrent_tasks[0])
+        self._single_func_queue = JoinableQueue(maxsize=self.concurrent_tasks[1])
+        self._output_queue = Queue(maxsize=self.concurrent_tasks[2])
+        self._task_time = multiprocessing.Value("d", 0.0)
+        # items put on the task queue, and taken from it by the multi-workers
+        self._n_put = 0
+        self._n_taken = multiprocessing.Value("l", 0)
+        # id of the current run, for the multi-workers
+        self._shared_run_id = multiprocessing.Value("l", 0)
+        self._metrics_queue = Queue()
+        self._metrics = Metrics(
+            self._metrics_queue,
+            {
+                "tasks": self._multi_func_queue,
+                "results": self._single_func_queue,
+                "output": self._output_queue,
+            },
+            self.metrics_interval,
+        )
+        self._last_metrics = time.perf_counter()
+        self._shm = None
+        if self.shared_memory:
+            self._shm = BlockPool(
+                self.shm_blocks, self.shm_block_size, self.shm_threshold
+            )
+
+        # set up workers, the single-worker is started by the first run that
+        # needs it
+        self._workers = []
+        self._multi_workers = []
+        self._single_worker = None
+        self._n_spawned = 0
+        # multi-workers asked to exit, that have not yet done so
+        self._n_retiring = 0
+        self._n_idle_checks = 0
+        self._multi_func = None
+        self._passthrough = False
+        self._single_func = None
+        for i in range(self._multi_bounds()[0]):
+            self._spawn_multi()
+        # stop the workers when the pool is garbage collected, or at exit
+        self._finalizer = weakref.finalize(self, _terminate, self._workers, self._shm)
+
+    def _multi_bounds(self):
+        """Minimum and maximum number of multi-workers for the current run"""
+        if self.backend == "asyncio":
+            # a single event loop runs all tasks
+            return 1, 1
+        low = self.min_workers - 1
+        high = self.max_workers - (1 if self._single_stage else 0)
+        return low, max(low, high)
+
+    def _worker_args(self, name, stage, task_queue, results_queue, stop_event):
+        control_queue = self._Queue()
+        args = (
+            name,
+            task_queue,
+            results_queue,
+            control_queue,
+            stop_event,
+            self.backend == "process",
+            self._shm,
+            WorkerMetrics(name, stage, self._metrics_queue, self.metrics_interval),
+            self.retries,
+        )
+        return control_queue, args
+
+    def _spawn_multi(self):
+        """Start a multi-worker"""
+        self._n_spawned += 1
+        stop_event = self._Event()
+        control_queue, args = self._worker_args(
+            f"MultiWorker-{self._n_spawned}",
+            "multi",
+            self._multi_func_queue,
+            self._single_func_queue,
+            stop_event,
+        )
+        slot = None
+        if self.backend == "asyncio":
+            worker = _AsyncioMultiWorker(
+                *args,
+                task_time=self._task_time,
+                output_queue=self._output_queue,
+                run_id=self._shared_run_id,
+                concurrency=self.max_workers - 1,
+                task_timeout=self.task_timeout,
+            )
+        else:
+            slot = multiprocessing.Array("d", [-1, 0, 0], lock=False)
+            worker = _MultiWorker(
+                *args,
+                slot,
+                task_time=self._task_time,
+                output_queue=self._output_queue,
+                n_taken=self._n_taken,
+                run_id=self._shared_run_id,
+            )
+        if self._multi_func is not None:
+            # workers that join later need the function of the current run
+            control_queue.put((self._func_id, self._multi_func, self._passthrough))
+        process = self._Worker(target=worker.run, name=worker.name)
+        handle = _WorkerHandle(process, stop_event, control_queue, slot)
+        self._workers.append(handle)
+        self._multi_workers.append(handle)
+        process.start()
+        return handle
+
+    def _spawn_single(self):
+        stop_event = self._Event()
+        control_queue, args = self._worker_args(
+            "SingleWorker",
+            "single",
+            self._single_func_queue,
+            self._output_queue,
+            stop_event,
+        )
+        worker = _SingleWorker(*args)
+        process = self._Worker(target=worker.run, name=worker.name)
+        self._single_worker = _WorkerHandle(process, stop_event, control_queue)
+        self._workers.append(self._single_worker)
+        process.start()
+
+    def _remove(self, handle):
+        self._workers.remove(handle)
+        self._multi_workers.remove(handle)
+        if self.backend == "process":
+            handle.control_queue.close()
+
+    def _retire(self):
+        """Ask one of the multi-workers to exit after its current chunk"""
+        try:
+            self._multi_func_queue.put_nowait(None)
+        except queue.Full:
+            return
+        self._n_put += 1
+        self._n_retiring += 1
+
+    def _scale(self):
+        """Add a multi-worker when tasks pile up, retire one when they run out"""
+        n_multi = len(self._multi_workers) - self._n_retiring
+        low, high = self._multi_bounds()
+        if n_multi < low:
+            self._spawn_multi()
+            return
+        if n_multi > high:
+            self._retire()
+            return
+        # with a single_func, results wait in the intermediate queue
+        stage = 1 if self._single_stage else 2
+        results_queue = (self._single_func_queue, self._output_queue)[stage - 1]
+        try:
+            n_tasks = self._multi_func_queue.qsize()
+            n_results = results_queue.qsize()
+        except NotImplementedError:
+            # multiprocessing queues can't tell their size on macOS
+            return
+        if n_tasks:
+            self._n_idle_checks = 0
+        else:
+            self._n_idle_checks += 1
+        # more workers don't help when the results are not picked up
+        if (
+            n_multi < high
+            and n_tasks >= n_multi
+            and n_results < self.concurrent_tasks[stage] // 2
+            and (self.backend != "process" or _cpu_available())
+        ):
+            self._spawn_multi()
+            logging.debug(f"funnel: scaled up to {n_multi + 1} multi-workers")
+        elif n_multi > low and self._n_idle_checks >= SCALE_DOWN_CHECKS:
+            self._n_idle_checks = 0
+            self._retire()
+            logging.debug(f"funnel: scaling down to {n_multi - 1} multi-workers")
+
+    def _close_queues(self):
+        if self.backend == "process":
+            queues = [w.control_queue for w in self._workers] + [
+                self._multi_func_queue,
+                self._single_func_queue,
+                self._output_queue,
+            ]
+            for q in queues:
+                q.close()
+            self._metrics_queue.close()
+        self._workers = []
+        self._multi_workers = []
+        self._single_worker = None
+
+    def close(self, timeout=5):
+        """Let the workers finish and stop them, terminating them after `timeout`"""
+        if not self.started or self._running:
+            self.terminate()
+            return
+        try:
+            for w in self._multi_workers:
+                self._multi_func_queue.put(None, timeout=timeout)
+            if self._single_worker is not None:
+                self._single_func_queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        deadline = time.monotonic() + timeout
+        for w in self._workers:
+            w.process.join(max(0, deadline - time.monotonic()))
+        self.terminate()
+
+    def terminate(self):
+        """Stop the workers immediately"""
+        if not self.started:
+            return
+        self._finalizer()
+        self._close_queues()
+
+    def _ship_functions(self, multi_func, single_func, ordered):
+        if self.backend == "process":
+            pmfunc = cloudpickle.dumps(multi_func)
+        else:
+            pmfunc = multi_func
+        passthrough = single_func is None
+        if pmfunc != self._multi_func or passthrough != self._passthrough:
+            self._func_id += 1
+            for w in self._multi_workers:
+                w.control_queue.put((self._func_id, pmfunc, passthrough))
+            self._multi_func, self._passthrough = pmfunc, passthrough
+        if single_func is None:
+            return
+        if self._single_worker is None:
+            self._spawn_single()
+        if self.backend == "process":
+            psfunc = cloudpickle.dumps(single_func)
+        else:
+            psfunc = single_func
+        changed = psfunc != self._single_func
+        self._single_func = psfunc
+        self._single_worker.control_queue.put(
+            (self._run_id, ordered, changed, psfunc if changed else None)
+        )
+
+    def metrics(self) -> dict:
+        """Metrics of the workers and queues, None before the pool has started
+
+        Returns a dict with
+        - "input" and "consumer": seconds the parent spent waiting for the
+          iterable and for the code consuming the results
+        - "stages" and "workers": per stage ("multi", "single") and per worker
+          the number of tasks and chunks, seconds spent busy, idle (waiting for
+          tasks) and blocked (waiting for room in the next queue), and a latency
+          histogram of tasks with upper bounds "latency_buckets"
+        - "queues": depth samples of the "tasks", "results" and "output" queues
+        Totals are kept for as long as the workers live, worker numbers are as
+        recent as their last report.
+        """
+        if self._metrics is None:
+            return None
+        return self._metrics.snapshot()
+
+    def _tick(self, force=False):
+        """Sample queue depths, and hand out metrics when they are due"""
+        self._metrics.sample()
+        now = time.perf_counter()
+        if force or now - self._last_metrics >= self.metrics_interval:
+            self._last_metrics = now
+            # drain the worker reports even when nobody asks for metrics
+            self._metrics.collect()
+            if self.on_metrics is not None or _debug_enabled():
+                snapshot = self._metrics.snapshot()
+                logging.debug(f"funnel metrics: {snapshot['stages']}")
+                if self.on_metrics is not None:
+                    self.on_metrics(snapshot)
+
+    def _emit(self, results):
+        """Yield results, keeping track of the time the consumer takes"""
+        # the parent does nothing else in between, so time the whole chunk
+        start = time.perf_counter()
+        yield from results
+        self._metrics.consumer += time.perf_counter() - start
+
+    def _fail(self, failure):
+        if self.dead_letter is None:
+            raise failure.error
+        self.dead_letter(failure.task, failure.error)
+
+    def _recover(self, worker, error):
+        """Replace a multi-worker, resubmitting the chunks it may have lost"""
+        worker.stop_event.set()
+        worker.process.terminate()
+        if self.backend == "process":
+            worker.process.join(1)
+        seq, index, busy = int(worker.slot[0]), int(worker.slot[1]), worker.slot[2]
+        logging.warning(f"Replacing {worker.process.name}: {error}")
+        self._remove(worker)
+        self._spawn_multi()
+        failure = None
+        if busy and seq in self._in_flight:
+            # the task that was running is not tried again
+            chunk = self._in_flight[seq]
+            failure = _Failure(chunk[index], error)
+            self._in_flight[seq] = chunk[:index] + chunk[index + 1 :]
+        lost = [seq] if seq in self._in_flight else []
+        if self.backend == "process":
+            # results a process put on a queue just before it died can be lost
+            # with it, so every chunk that was taken and is not done yet is sent
+            # again, chunks still waiting in the task queue are left alone
+            n_taken = self._n_taken.value
+            lost += [
+                taken
+                for taken, position in self._positions.items()
+                if position < n_taken and taken in self._in_flight and taken != seq
+            ]
+        resubmitted = {item[2] for item in self._resubmits}
+        for seq in lost:
+            if seq not in resubmitted:
+                chunk = self._in_flight[seq]
+                self._resubmits.append((self._run_id, self._func_id, seq, chunk))
+        if failure is not None:
+            self._fail(failure)
+
+    def _check(self):
+        """Look after the multi-workers, raise if the run can't go on
+
+        Retired workers are cleaned up, dead or stuck ones are replaced, and
+        every SCALE_INTERVAL seconds the number of workers is adjusted.
+        """
+        now = time.monotonic()
+        if now - self._last_check < POLL_INTERVAL:
+            return
+        self._last_check = now
+        for worker in list(self._multi_workers):
+            exitcode, slot = worker.process.exitcode, worker.slot
+            if exitcode == 0:
+                self._remove(worker)
+                self._n_retiring = max(0, self._n_retiring - 1)
+            elif slot is None:
+                # the watchdog looks after the asyncio worker
+                continue
+            elif exitcode:
+                self._recover(
+                    worker,
+                    RuntimeError(
+                        f"{worker.process.name} exited unexpectedly "
+                        f"(exit code {exitcode})"
+                    ),
+                )
+            elif (
+                self.task_timeout is not None
+                and slot[2]
+                and time.time() - slot[2] > self.task_timeout
+            ):
+                self._recover(
+                    worker, TimeoutError(f"Task took over {self.task_timeout} seconds")
+                )
+        self._watchdog.check()
+        if now - self._last_scale >= SCALE_INTERVAL:
+            self._last_scale = now
+            self._scale()
+
+    def _receive(self, block):
+        """Get the results of chunks that are done, None if there are none
+
+        Results come from the single-worker, or, without a single_func, from
+        the multi-workers, in which case the parent restores the order.
+        """
+        self._check()
+        try:
+            if block:
+                item = self._output_queue.get(timeout=POLL_INTERVAL)
+            else:
+                item = self._output_queue.get_nowait()
+        except queue.Empty:
+            if block:
+                self._tick()
+            return None
+        self._watchdog.progress()
+        run_id, seq, results, failures = item
+        if not self._single_stage:
+            results, failures = _split_failures(results)
+        if self._shm is not None:
+            results = [self._shm.decode(result) for result in results]
+        if run_id != self._run_id or self._in_flight.pop(seq, None) is None:
+            # a resubmitted chunk that was done before
+            return []
+        for failure in failures or []:
+            self._fail(failure)
+        if self._single_stage or not self._ordered:
+            self._n_done += 1
+            return results
+        self._reorder_buffer[seq] = results
+        results = []
+        while self._n_done in self._reorder_buffer:
+            results.extend(self._reorder_buffer.pop(self._n_done))
+            self._n_done += 1
+        return results
+
+    def _resubmit(self):
+        """Put chunks of replaced workers back on the task queue"""
+        while self._resubmits:
+            yield from self._put(self._resubmits.pop(0))
+
+    def _drain(self):
+        """Yield all results that are ready, without blocking"""
+        while True:
+            results = self._receive(block=False)
+            if results is None:
+                return
+            yield from self._emit(results)
+
+    def _wait(self):
+        """Wait for the results of a chunk, and yield them"""
+        yield from self._emit(self._receive(block=True) or [])
+
+    def _timed(self, chunks):
+        """Iterate over chunks, keeping track of the time taken to read the input"""
+        while True:
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            self._metrics.input += time.perf_counter() - start
+            if chunk is None:
+                return
+            yield chunk
+
+    def _put(self, item):
+        """Put a chunk on the task queue, yielding ready results while it is full
+
+        Results have to be collected while waiting, otherwise full queues further
+        down the line could keep the workers from ever taking the chunk.
+        """
+        while True:
+            try:
+                self._multi_func_queue.put(item, timeout=POLL_INTERVAL)
+            except queue.Full:
+                self._check()
+                self._tick()
+                yield from self._drain()
+            else:
+                # the task queue hands out items in the order they were put
+                self._positions[item[2]] = self._n_put
+                self._n_put += 1
+                self._watchdog.progress()
+                self._tick()
+                return
+
+    def run(
+        self,
+        iterable,
+        multi_func,
+        single_func=None,
+        timeout=None,
+        chunksize=1,
+        ordered=False,
+        window=None,
+    ):
+        """Process an iterable with the pool, yielding the results
+
+        See `funnel` for the parameters. If the run does not finish, e.g. when
+        the generator is closed early or a worker fails, the workers are
+        terminated and restarted on the next run.
+        """
+        if self._running:
+            raise RuntimeError("Funnel can only process one iterable at a time")
+        self._single_stage = single_func is not None
+        if not self.started:
+            self._start()
+        self._running = True
+        self._run_id += 1
+        self._shared_run_id.value = self._run_id
+        self._ordered = ordered
+        self._n_done = 0
+        # chunks submitted but not done, by seq, and chunks to submit again
+        self._in_flight = {}
+        self._resubmits = []
+        # position in the task queue of the last submission of each chunk
+        self._positions = {}
+        # results that are ready ahead of their turn, when the parent orders them
+        self._reorder_buffer = {}
+        self._last_check = self._last_scale = time.monotonic()
+        finished = False
+        try:
+            self._ship_functions(multi_func, single_func, ordered)
+            # multi-workers that died are replaced, except with asyncio
+            watched = [w.process for w in self._multi_workers if w.slot is None]
+            if self._single_stage:
+                watched.append(self._single_worker.process)
+            self._watchdog = _Watchdog(watched, timeout)
+            if chunksize == "auto":
+                self._task_time.value = 0.0
+            task_time = self._task_time if chunksize == "auto" else None
+            if ordered:
+                window = window or sum(self.concurrent_tasks)
+
+            # Start processing
+            n_submitted = 0
+            chunks = _chunks(
+                iterable, 1 if chunksize == "auto" else chunksize, task_time
+            )
+            for seq, chunk in enumerate(self._timed(chunks)):
+                # with ordered results, limit how far workers can run ahead
+                while ordered and n_submitted - self._n_done >= window:
+                    yield from self._resubmit()
+                    yield from self._wait()
+                yield from self._resubmit()
+                self._in_flight[seq] = chunk
+                yield from self._put((self._run_id, self._func_id, seq, chunk))
+                n_submitted += 1
+                yield from self._drain()
+
+            # every chunk results in a list of results
+            while self._n_done < n_submitted:
+                yield from self._resubmit()
+                yield from self._wait()
+            finished = True
+            self._tick(force=True)
+
+        finally:
+            self._running = False
+            if not finished:
+                self.terminate()
 
 
 def funnel(
@@ -81,6 +1238,15 @@ def funnel(
     n_workers=3,
     concurrent_tasks=(100, 100, 100),
     timeout=None,
+    chunksize=1,
+    ordered=False,
+    window=None,
+    backend="process",
+    shared_memory=False,
+    on_metrics=None,
+    retries=0,
+    task_timeout=None,
+    dead_letter=None,
 ):
     """Fan-in multiprocessing utility function
 
@@ -107,77 +1273,72 @@ def funnel(
     single_func : Callable (default None)
         A function that should NOT process the results of the multi_func in parallel,
         but individually in the same thread. Will simply pass through `multi_func`
-        results when set to None.
+        results when set to None, which needs no single-worker.
         NOTE: a tuple passed BY the multi-func will be considered as positional
         arguments (*args), a dictionary passed BY the multi func will be considered
         keyword arguments (**kwargs).  Avoid unwanted unpacking by passing
         dictionaries or tuples that should not be interpreted
         as arguments wrapped in a tuple, e.g. ({"my_dict":"is not a set of kwargs},)
-    timeout : int
-        How long to wait for jobs to finish
+    n_workers : int or tuple of 2 ints (default 3)
+        Number of workers, including the single-worker if there is a
+        `single_func`. A (min, max) tuple scales the number of multi-workers
+        with the load; see `Funnel`
+    concurrent_tasks : tuple of 3 ints (default (100, 100, 100))
+        Maximum size of the task, intermediate result and output queues
+    timeout : float (default None)
+        How long to wait, in seconds, for progress (a task being accepted or a
+        result coming in) before giving up with a TimeoutError
+    chunksize : int or "auto" (default 1)
+        Number of items sent to a worker at a time. Items and results travel
+        between processes in chunks, which amortizes the pickling and queue overhead
+        for small, cheap tasks. Note that `concurrent_tasks` then counts chunks.
+        With "auto", the chunk size is tuned so every chunk takes about
+        TARGET_CHUNK_TIME seconds, based on the measured time per task.
+    ordered : bool (default False)
+        Pass results to `single_func`, and yield them, in the order of the
+        iterable. Results that finish early wait in a reorder buffer.
+    window : int (default None)
+        With `ordered`, the maximum number of chunks that may be in flight at
+        once, which bounds the reorder buffer when fast workers run ahead of a
+        slow one. Defaults to the total of `concurrent_tasks`.
+    backend : str (default "process")
+        Run the workers as processes, or as "thread"s or on an "asyncio" event
+        loop for I/O-bound functions; see `Funnel`
+    shared_memory : bool (default False)
+        Move large NumPy arrays and bytes between processes through shared
+        memory; see `Funnel`
+    on_metrics : Callable (default None)
+        Called with the metrics of the workers and queues every second, and
+        when done; see `Funnel.metrics`
+    retries : int (default 0)
+        Number of times a failing task is retried before it fails
+    task_timeout : float (default None)
+        Maximum time in seconds for a multi_func task, the worker running it is
+        replaced when it takes longer
+    dead_letter : Callable (default None)
+        Called with (task, error) for tasks that failed, so the run can go on;
+        without it the error is raised. See `Funnel`.
     """
-
-    # Sanity check
-    if n_workers < 2:
-        raise ValueError(
-            "`n_workers` should be 2 or higher; "
-            "At least 1 multi-worker and 1 single-worker is needed."
-        )
-
-    # set up queues
-    multi_func_queue = multiprocessing.JoinableQueue(maxsize=concurrent_tasks[0])
-    single_func_queue = multiprocessing.JoinableQueue(maxsize=concurrent_tasks[1])
-    output_queue = multiprocessing.Queue(maxsize=concurrent_tasks[2])
-
-    # set up workers
-    pmfunc = cloudpickle.dumps(multi_func)
-    psfunc = cloudpickle.dumps(single_func)
-
-    multi_workers = [
-        _MultiWorker(multi_func_queue, single_func_queue, pmfunc)
-        for i in range(n_workers - 1)
-    ]
-    single_worker = _SingleWorker(single_func_queue, output_queue, psfunc)
-
-    for w in multi_workers:
-        w.start()
-    single_worker.start()
-
+    pool = Funnel(
+        n_workers,
+        concurrent_tasks,
+        backend,
+        shared_memory,
+        on_metrics=on_metrics,
+        retries=retries,
+        task_timeout=task_timeout,
+        dead_letter=dead_letter,
+    )
     try:
-
-        # Start processing
-        for i in iterable:
-            if not output_queue.empty():
-                yield output_queue.get_nowait()
-            multi_func_queue.put(i)
-
-        logging.debug("Submitting multi-func kill signal")
-        for i in range(n_workers - 1):
-            multi_func_queue.put(None)
-
-        single_stop_submitted = False
-        while True:
-            if not output_queue.empty():
-                result = output_queue.get()
-                # if none, we've reached the end of processing
-                if isinstance(result, type(None)):
-                    break
-                yield result
-            # check if the multi_func workers are still working
-            alive_workers = [w for w in multi_workers if w.is_alive()]
-            if not alive_workers and not single_stop_submitted:
-                logging.debug("Submitting single-func kill signal")
-                single_func_queue.put(None)
-                single_stop_submitted = True
-            if not single_worker.is_alive():
-                break
-
+        yield from pool.run(
+            iterable,
+            multi_func,
+            single_func,
+            timeout=timeout,
+            chunksize=chunksize,
+            ordered=ordered,
+            window=window,
+        )
     finally:
-
         # cleanup
-        for w in multi_workers:
-            w.terminate()
-        single_worker.terminate()
-        multi_func_queue.close()
-        single_func_queue.close()
-        output_queue.close()
+        pool.terminate()
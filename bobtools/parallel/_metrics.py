@@ -0,0 +1,155 @@
+"""Lightweight run-time metrics for funnel workers and queues
+
+Workers count tasks and time spent busy (processing), idle (waiting for work)
+and blocked (waiting for room downstream), and keep a histogram of task
+latencies. To keep the cost per task down, tasks sent in chunks are all
+recorded with the average latency of their chunk. Workers send their totals to
+the parent at most every `interval` seconds. The parent adds the time spent
+reading the input iterable and waiting for the consumer, and samples queue
+depths, so a slow run shows where the bottleneck is.
+"""
+
+import bisect
+import queue
+import time
+
+METRICS_INTERVAL = 1.0
+# upper bounds (in seconds) of the latency histogram buckets, the last bucket
+# counts everything slower
+LATENCY_BUCKETS = (1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1.0, 10.0)
+
+_COUNTERS = ("tasks", "chunks", "busy", "idle", "blocked", "retries", "failed")
+
+
+class WorkerMetrics:
+    """Counters of a single worker, reported to the parent now and then"""
+
+    def __init__(self, name, stage, report_queue=None, interval=METRICS_INTERVAL):
+        self.name = name
+        self.stage = stage
+        self.report_queue = report_queue
+        self.interval = interval
+        self.tasks = 0
+        self.chunks = 0
+        self.busy = 0.0
+        self.idle = 0.0
+        self.blocked = 0.0
+        self.retries = 0
+        self.failed = 0
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self._last_report = time.perf_counter()
+        self._reported = None
+
+    def task(self, seconds, n=1):
+        """Record `n` tasks that took `seconds` each"""
+        self.tasks += n
+        self.latency[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += n
+
+    def to_dict(self) -> dict:
+        metrics = {counter: getattr(self, counter) for counter in _COUNTERS}
+        metrics["latency"] = list(self.latency)
+        return metrics
+
+    def report(self, force=False):
+        """Send the totals to the parent, if `interval` seconds have passed
+
+        Unchanged totals are not sent again, so idle workers send nothing.
+        """
+        if self.report_queue is None:
+            return
+        now = time.perf_counter()
+        if force or now - self._last_report >= self.interval:
+            self._last_report = now
+            metrics = self.to_dict()
+            if metrics != self._reported:
+                self._reported = metrics
+                self.report_queue.put((self.name, self.stage, metrics))
+
+
+def _combine(metrics: list) -> dict:
+    combined = {counter: 0 for counter in _COUNTERS}
+    combined["latency"] = [0] * (len(LATENCY_BUCKETS) + 1)
+    for worker in metrics:
+        for counter in _COUNTERS:
+            combined[counter] += worker[counter]
+        combined["latency"] = [
+            a + b for a, b in zip(combined["latency"], worker["latency"])
+        ]
+    return combined
+
+
+class _QueueDepth:
+    def __init__(self, q):
+        self.q = q
+        self.samples = 0
+        self.total = 0
+        self.max = 0
+        self.last = 0
+
+    def sample(self):
+        try:
+            depth = self.q.qsize()
+        except NotImplementedError:
+            # multiprocessing queues can't tell their size on macOS
+            return
+        self.samples += 1
+        self.total += depth
+        self.max = max(self.max, depth)
+        self.last = depth
+
+    def to_dict(self) -> dict:
+        return {
+            "samples": self.samples,
+            "mean": self.total / self.samples if self.samples else 0.0,
+            "max": self.max,
+            "last": self.last,
+        }
+
+
+class Metrics:
+    """Collects worker reports and queue depths in the parent"""
+
+    def __init__(self, report_queue, queues: dict, interval=METRICS_INTERVAL):
+        self.report_queue = report_queue
+        self.queues = {name: _QueueDepth(q) for name, q in queues.items()}
+        self.interval = interval
+        self.workers = {}
+        # time the parent spent waiting for the input iterable and the consumer
+        self.input = 0.0
+        self.consumer = 0.0
+        self._last_sample = 0.0
+
+    def collect(self):
+        """Process the reports workers sent so far"""
+        while True:
+            try:
+                name, stage, metrics = self.report_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.workers[name] = dict(metrics, stage=stage)
+
+    def sample(self):
+        """Sample the queue depths, at most every `interval` / 10 seconds"""
+        now = time.perf_counter()
+        if now - self._last_sample >= self.interval / 10:
+            self._last_sample = now
+            for depth in self.queues.values():
+                depth.sample()
+
+    def snapshot(self) -> dict:
+        """All metrics so far, by stage, worker and queue
+
+        Worker totals are as recent as their last report.
+        """
+        self.collect()
+        stages = {}
+        for metrics in self.workers.values():
+            stages.setdefault(metrics["stage"], []).append(metrics)
+        return {
+            "input": {"busy": self.input},
+            "consumer": {"busy": self.consumer},
+            "stages": {stage: _combine(metrics) for stage, metrics in stages.items()},
+            "workers": {name: dict(metrics) for name, metrics in self.workers.items()},
+            "queues": {name: depth.to_dict() for name, depth in self.queues.items()},
+            "latency_buckets": LATENCY_BUCKETS,
+        }
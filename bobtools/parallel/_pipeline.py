@@ -0,0 +1,257 @@
+import multiprocessing
+import queue
+import threading
+import time
+from typing import Callable, List, NamedTuple, Optional
+
+import cloudpickle
+
+from bobtools.parallel._funnel import (
+    POLL_INTERVAL,
+    _call,
+    _chunks,
+    _Thread,
+    _Watchdog,
+    _Worker,
+)
+
+
+class Stage(NamedTuple):
+    func: Optional[Callable]
+    n_workers: int = 1
+    queue_size: int = 100
+    name: Optional[str] = None
+
+
+# tells the other workers of a stage to exit, once all of its input is in
+_STOP = "stop"
+
+
+class _StageWorker(_Worker):
+    """Worker of a pipeline stage
+
+    Every producer (the parent, or a worker of the previous stage) sends a None
+    after its last results. Items sent by one producer arrive in order, so the
+    worker that receives the last of these knows the input is complete; it then
+    tells the other workers of the stage to stop. Every worker sends a None on
+    to the next stage when it exits.
+    """
+
+    def __init__(
+        self, name, task_queue, results_queue, stop_event, pickled, func, producers
+    ):
+        _Worker.__init__(
+            self, name, task_queue, results_queue, None, stop_event, pickled
+        )
+        self.stage_func = func
+        # the number of producers, the (shared) number of Nones received from them
+        # and the number of workers in this stage
+        self.n_producers, self.n_done, self.n_workers = producers
+
+    def _run(self):
+        self.func = self._load(self.stage_func)
+        while True:
+            chunk = self._get(self.task_queue)
+            if chunk is None:
+                with self.n_done.get_lock():
+                    self.n_done.value += 1
+                    last = self.n_done.value == self.n_producers
+                if last:
+                    for i in range(self.n_workers - 1):
+                        self._put(self.task_queue, _STOP)
+                    break
+                continue
+            if chunk == _STOP:
+                break
+            start = time.perf_counter()
+            if not self.func:
+                results = chunk
+            else:
+                results = []
+                for task in chunk:
+                    result = _call(self.func, task)
+                    if not isinstance(result, type(None)):
+                        results.append(result)
+            self._chunk_done(start, len(chunk) if self.func else 0)
+            if results:
+                self._put(self.results_queue, results)
+        self._put(self.results_queue, None)
+
+
+class Pipeline:
+    """Chain of processing stages, each with its own workers
+
+    Items from the iterable pass through every stage in turn. Each stage
+    applies its function with `n_workers` processes (or threads) and takes its
+    input from a queue of at most `queue_size` chunks, so a slow stage holds back
+    the stages before it. Like funnel's single_func, a stage drops None results,
+    and tuples and dicts are unpacked as *args and **kwargs. Results are yielded
+    as they come out of the last stage, in no particular order.
+
+    Parameters
+    ---
+    backend : str (default "process")
+        Run the workers as processes, or as threads ("thread") for I/O-bound
+        functions
+    output_queue_size : int (default 100)
+        Maximum number of chunks of results waiting for the consumer
+
+    Example
+    ---
+    pipeline = (
+        Pipeline()
+        .stage(parse, n_workers=2)
+        .stage(enrich, n_workers=8, queue_size=200)
+        .stage(dedupe)
+        .stage(write)
+    )
+    for result in pipeline.run(lines):
+        ...
+
+    funnel(iterable, multi_func, single_func, n_workers=3) is the two stage
+    pipeline Pipeline().stage(multi_func, n_workers=2).stage(single_func), with
+    the difference that funnel passes None results of multi_func on to single_func.
+    """
+
+    def __init__(self, backend="process", output_queue_size=100):
+        if backend not in ("process", "thread"):
+            raise ValueError(f"Unknown backend {backend}, choose from process, thread")
+        self.backend = backend
+        self.output_queue_size = output_queue_size
+        self.stages: List[Stage] = []
+
+    def __repr__(self):
+        stages = " -> ".join(
+            f"{stage.name}({stage.n_workers})" for stage in self.stages
+        )
+        return f"<Pipeline {stages}>"
+
+    def stage(
+        self,
+        func: Optional[Callable],
+        n_workers: int = 1,
+        queue_size: int = 100,
+        name: str = None,
+    ) -> "Pipeline":
+        """Add a stage applying `func` with `n_workers`, returns the pipeline
+
+        A stage with n_workers=1 processes its input serially, like funnel's
+        single_func. With func None, the stage passes its input through.
+        """
+        if n_workers < 1:
+            raise ValueError("A stage needs at least 1 worker")
+        if name is None and func is not None:
+            name = getattr(func, "__name__", type(func).__name__)
+        elif name is None:
+            name = f"stage-{len(self.stages) + 1}"
+        self.stages.append(Stage(func, n_workers, queue_size, name))
+        return self
+
+    def _start(self):
+        if self.backend == "process":
+            Worker, Queue, Value = (
+                multiprocessing.Process,
+                multiprocessing.Queue,
+                multiprocessing.Value,
+            )
+            self._stop_event = multiprocessing.Event()
+        else:
+            Worker, Queue, Value = _Thread, queue.Queue, multiprocessing.Value
+            self._stop_event = threading.Event()
+        pickled = self.backend == "process"
+
+        # the input queue of every stage, and the output queue
+        self._queues = [Queue(maxsize=stage.queue_size) for stage in self.stages]
+        self._queues.append(Queue(maxsize=self.output_queue_size))
+
+        self._workers = []
+        for i, stage in enumerate(self.stages):
+            func = cloudpickle.dumps(stage.func) if pickled else stage.func
+            # the parent feeds the first stage
+            n_producers = self.stages[i - 1].n_workers if i else 1
+            n_done = Value("i", 0)
+            for j in range(stage.n_workers):
+                worker = _StageWorker(
+                    f"{stage.name}-{j + 1}",
+                    self._queues[i],
+                    self._queues[i + 1],
+                    self._stop_event,
+                    pickled,
+                    func,
+                    (n_producers, n_done, stage.n_workers),
+                )
+                self._workers.append(Worker(target=worker.run, name=worker.name))
+        for w in self._workers:
+            w.start()
+
+    def _stop(self):
+        self._stop_event.set()
+        for w in self._workers:
+            w.terminate()
+        if self.backend == "process":
+            for q in self._queues:
+                q.close()
+
+    def _drain(self):
+        """Yield all results that are ready, without blocking"""
+        while True:
+            try:
+                results = self._queues[-1].get_nowait()
+            except queue.Empty:
+                return
+            self._watchdog.progress()
+            if results is None:
+                self._n_finished += 1
+                continue
+            yield from results
+
+    def _put(self, item):
+        """Put a chunk on the first queue, yielding ready results while it is full"""
+        while True:
+            try:
+                self._queues[0].put(item, timeout=POLL_INTERVAL)
+            except queue.Full:
+                self._watchdog.check()
+                yield from self._drain()
+            else:
+                self._watchdog.progress()
+                return
+
+    def run(self, iterable, timeout=None, chunksize=1):
+        """Process an iterable with the pipeline, yielding results of the last stage
+
+        Parameters
+        ---
+        iterable : Iterable
+            The items to process
+        timeout : float (default None)
+            How long to wait, in seconds, for progress before giving up with a
+            TimeoutError
+        chunksize : int (default 1)
+            Number of items that travel between stages together, see funnel
+        """
+        if not self.stages:
+            raise ValueError("The pipeline has no stages")
+        self._start()
+        self._watchdog = _Watchdog(self._workers, timeout)
+        self._n_finished = 0
+        try:
+            for chunk in _chunks(iterable, chunksize):
+                yield from self._put(chunk)
+                yield from self._drain()
+
+            # shut down stage by stage, every worker of the last stage sends a None
+            yield from self._put(None)
+            while self._n_finished < self.stages[-1].n_workers:
+                try:
+                    results = self._queues[-1].get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    self._watchdog.check()
+                    continue
+                self._watchdog.progress()
+                if results is None:
+                    self._n_finished += 1
+                    continue
+                yield from results
+        finally:
+            self._stop()
@@ -0,0 +1,115 @@
+"""Shared memory transport for large funnel payloads
+
+Results that are (or contain) NumPy arrays or bytes of at least `threshold`
+bytes are copied into a block from a fixed pool of shared memory segments, and
+only a small handle travels through the queues. The receiver copies the data
+out and returns the block to the pool. When no block is free, or the payload
+does not fit in one, it is simply pickled as usual.
+"""
+
+import queue
+import sys
+from typing import NamedTuple, Optional
+
+SHM_THRESHOLD = 1024 * 1024
+SHM_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+class _Handle(NamedTuple):
+    # name of the shared memory block holding the payload
+    name: str
+    size: int
+    # numpy dtype and shape for arrays, None for bytes
+    dtype: Optional[object] = None
+    shape: tuple = ()
+
+
+class BlockPool:
+    """Pool of shared memory blocks, shared between the funnel processes
+
+    Created in the parent, workers inherit it (or attach when pickled). Blocks
+    are handed out through a free-list queue.
+    """
+
+    def __init__(self, n_blocks, block_size=SHM_BLOCK_SIZE, threshold=SHM_THRESHOLD):
+        import multiprocessing
+        from multiprocessing import shared_memory
+
+        self.block_size = block_size
+        self.threshold = threshold
+        self.blocks = {}
+        self.free = multiprocessing.Queue()
+        for i in range(n_blocks):
+            block = shared_memory.SharedMemory(create=True, size=block_size)
+            self.blocks[block.name] = block
+            self.free.put(block.name)
+
+    def close(self):
+        """Release all blocks, only to be called by the parent"""
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+        self.free.close()
+
+    def _store(self, obj):
+        np = sys.modules.get("numpy")
+        if isinstance(obj, (bytes, bytearray)):
+            size, dtype = len(obj), None
+        elif np is not None and isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+            size, dtype = obj.nbytes, obj.dtype
+        else:
+            return obj
+        if size < self.threshold or size > self.block_size:
+            return obj
+        try:
+            name = self.free.get_nowait()
+        except queue.Empty:
+            return obj
+        buf = self.blocks[name].buf
+        if dtype is None:
+            buf[:size] = obj
+            return _Handle(name, size)
+        np.ndarray(obj.shape, dtype, buffer=buf)[...] = obj
+        return _Handle(name, size, dtype, obj.shape)
+
+    def _load(self, handle):
+        buf = self.blocks[handle.name].buf
+        if handle.dtype is None:
+            obj = bytes(buf[: handle.size])
+        else:
+            import numpy as np
+
+            obj = np.ndarray(handle.shape, handle.dtype, buffer=buf).copy()
+        self.free.put(handle.name)
+        return obj
+
+    def encode(self, result):
+        """Move large payloads in a result (or in its tuple, list or dict) to blocks"""
+        if type(result) in (tuple, list):
+            return type(result)(self._store(item) for item in result)
+        elif type(result) is dict:
+            return {key: self._store(value) for key, value in result.items()}
+        return self._store(result)
+
+    def release(self, result):
+        """Return the blocks of an encoded result to the pool, without copying"""
+        items = result.values() if type(result) is dict else result
+        if type(result) not in (tuple, list, dict):
+            items = [result]
+        for item in items:
+            if type(item) is _Handle:
+                self.free.put(item.name)
+
+    def decode(self, result):
+        """Copy payloads encoded by `encode` out of their blocks, freeing them"""
+        if type(result) in (tuple, list):
+            return type(result)(
+                self._load(item) if type(item) is _Handle else item for item in result
+            )
+        elif type(result) is dict:
+            return {
+                key: self._load(value) if type(value) is _Handle else value
+                for key, value in result.items()
+            }
+        return self._load(result) if type(result) is _Handle else result
@@ -11,4 +11,5 @@ setup(
     url="tba",
     packages=find_packages(),
     install_requires=["requests", "pandas", "cloudpickle"],
+    extras_require={"fast": ["orjson"]},
 )
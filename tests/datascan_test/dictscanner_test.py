@@ -1,6 +1,7 @@
 import unittest
 
-from bobtools.datascan import DictScanner
+from bobtools.datascan import DictScanner, SchemaDrift, SchemaDriftError
+from bobtools.datascan._hyperloglog import HyperLogLog, hash64
 
 
 class dictScannerTests(unittest.TestCase):
@@ -71,6 +72,180 @@ class dictScannerTests(unittest.TestCase):
         expected = {"a": {"d": type(1), "e": type(2)}, "b": type("3"), "c": type("4")}
         self.assertEqual(ds.to_schema(), expected)
 
+    def test_stats(self):
+        data = [{"a": i % 100, "b": None if i % 4 else str(i)} for i in range(1000)]
+        data.append({"a": "text"})
+        ds = DictScanner(data)
+        stats = ds.to_stats()
+
+        self.assertEqual(stats[("a",)]["count"], 1001)
+        self.assertEqual(stats[("a",)]["types"], {int: 1000, str: 1})
+        self.assertEqual(stats[("a",)]["bounds"], {int: (0, 99), str: ("text", "text")})
+        self.assertAlmostEqual(stats[("a",)]["distinct"], 101, delta=5)
+        self.assertEqual(len(stats[("a",)]["sample"]), 10)
+        self.assertEqual(stats[("b",)]["nulls"], 750)
+        self.assertEqual(list(stats[("b",)]["types"]), [str, type(None)])
+        self.assertEqual(ds.to_schema(), {"a": "multiple", "b": str})
+        self.assertEqual(ds.to_prototype(), {"a": "text", "b": "996"})
+
+    def test_bounded_memory(self):
+        ds = DictScanner()
+        ds.scan_all({"a": i} for i in range(10000))
+        leaf = ds.root[("a",)]
+        self.assertNotIn("values", leaf)
+        self.assertEqual(len(leaf["sample"]), 10)
+        # the sample does not depend on the scan order
+        reverse = DictScanner()
+        reverse.scan_all({"a": i} for i in reversed(range(10000)))
+        self.assertEqual(reverse.root[("a",)]["sample"], leaf["sample"])
+
+    def test_merge(self):
+        data = [
+            {"a": i, "b": {"c": [str(i), None]}, "d": i * 0.5 if i % 3 else None}
+            for i in range(3000)
+        ]
+        data[1500]["e"] = [{"f": True}]
+        data[2999]["a"] = "last"
+        sequential = DictScanner(data)
+
+        shards = [
+            DictScanner(data[i : i + 1000]).to_bytes() for i in range(0, 3000, 1000)
+        ]
+        merged = DictScanner()
+        for shard in shards:
+            merged.merge(DictScanner.from_bytes(shard))
+
+        self.assertEqual(merged.n_scanned, sequential.n_scanned)
+        self.assertEqual(merged.root, sequential.root)
+        self.assertEqual(list(merged.root), list(sequential.root))
+        self.assertEqual(merged.to_schema(), sequential.to_schema())
+        self.assertEqual(merged.to_prototype(), sequential.to_prototype())
+        self.assertEqual(merged.to_stats(), sequential.to_stats())
+
+    def test_sampling(self):
+        data = [{"a": i} for i in range(1000)]
+
+        ds = DictScanner()
+        self.assertEqual(ds.scan_all(data, every=10), 100)
+        self.assertEqual((ds.n_scanned, ds.n_skipped), (100, 900))
+        self.assertEqual(ds.to_stats()[("a",)]["bounds"], {int: (0, 990)})
+
+        ds = DictScanner()
+        n = ds.scan_all(data, fraction=0.2, seed=1)
+        self.assertAlmostEqual(n, 200, delta=50)
+        self.assertEqual(ds.n_scanned + ds.n_skipped, 1000)
+
+        ds = DictScanner()
+        self.assertEqual(ds.scan_all(iter(data), reservoir=50, seed=1), 50)
+        self.assertEqual(ds.n_skipped, 950)
+        self.assertGreater(ds.to_stats()[("a",)]["bounds"][int][1], 500)
+        # the same seed, the same sample
+        again = DictScanner()
+        again.scan_all(iter(data), reservoir=50, seed=1)
+        self.assertEqual(again.root, ds.root)
+
+        with self.assertRaises(ValueError):
+            ds.scan_all(data, every=2, fraction=0.5)
+
+    def test_early_stop(self):
+        data = [{"a": i, "b": "x"} for i in range(100000)]
+        data[5]["c"] = 1.0
+        data[50]["b"] = None
+
+        ds = DictScanner()
+        self.assertEqual(ds.scan_all(data, stop_after=100), 151)
+        self.assertEqual(ds.to_schema(), {"a": int, "b": str, "c": float})
+
+    def test_deep_record(self):
+        import sys
+
+        record = {"value": 1}
+        for level in range(sys.getrecursionlimit() + 100):
+            record = {"child": record}
+        ds = DictScanner([record])
+        self.assertEqual(len(ds.root), 1)
+        self.assertEqual(len(next(iter(ds.root))), sys.getrecursionlimit() + 101)
+
+    def test_every_list_item_counts(self):
+        data = [{"a": [1, "two", None], "b": [{"c": 1}, {"c": 2.0}], "d": [[1, 2]]}]
+        ds = DictScanner(data)
+        stats = ds.to_stats()
+        self.assertEqual(stats[("a", "__list__")]["count"], 3)
+        self.assertEqual(stats[("b", "__list__", "c")]["types"], {int: 1, float: 1})
+        # lists in lists are values
+        self.assertEqual(stats[("d", "__list__")]["types"], {list: 1})
+        self.assertEqual(
+            ds.to_schema(),
+            {"a": ["multiple"], "b": [{"c": "multiple"}], "d": [list]},
+        )
+
+    def test_drift_events(self):
+        events = []
+        ds = DictScanner(on_drift=events.append)
+        ds.scan_all([{"a": 1}, {"a": 2}, {"a": None}])
+        self.assertEqual(
+            events,
+            [
+                SchemaDrift("new_path", ("a",), int, 1),
+                SchemaDrift("new_type", ("a",), type(None), 3),
+            ],
+        )
+        version = ds.version
+
+        ds.scan_all([{"a": 3}, {"a": "four", "b": {"c": 1}}])
+        self.assertEqual(
+            events[2:],
+            [
+                SchemaDrift("new_type", ("a",), str, 5),
+                SchemaDrift("conflict", ("a",), str, 5),
+                SchemaDrift("new_path", ("b", "c"), int, 5),
+            ],
+        )
+        # one for the new type, two for the new path and its type
+        self.assertEqual(ds.version, version + 3)
+
+        # merging reports drift too
+        other = DictScanner([{"d": 1.0}])
+        ds.merge(other)
+        self.assertEqual(events[-1], SchemaDrift("new_path", ("d",), float, 6))
+
+    def test_drift_raises(self):
+        ds = DictScanner(on_drift="raise")
+        with self.assertRaises(SchemaDriftError):
+            ds.scan_this({"a": 1})
+        ds.scan_this({"a": 2})
+        with self.assertRaises(SchemaDriftError) as context:
+            ds.scan_this({"a": "x", "b": 1})
+        self.assertEqual(
+            [event.kind for event in context.exception.events],
+            ["new_type", "conflict", "new_path"],
+        )
+        # the record was scanned completely
+        self.assertEqual(ds.n_scanned, 3)
+        self.assertEqual(ds.to_schema(), {"a": "multiple", "b": int})
+
+    def test_cached_schema(self):
+        ds = DictScanner([{"a": i} for i in range(10)])
+        schema = ds.to_schema()
+        ds.scan_all([{"a": 10}])
+        self.assertIs(ds.to_schema(), schema)
+        ds.scan_all([{"b": "new"}])
+        self.assertEqual(ds.to_schema(), {"a": int, "b": str})
+
+        # the version follows from the state
+        restored = DictScanner.from_bytes(ds.to_bytes())
+        self.assertEqual(restored.version, ds.version)
+
+    def test_hyperloglog(self):
+        for n in [0, 10, 1000, 100000]:
+            hll = HyperLogLog()
+            for i in range(n):
+                hll.add(hash64(i))
+            self.assertAlmostEqual(hll.count(), n, delta=max(1, n * 0.1))
+
+        self.assertNotEqual(hash64(1), hash64("1"))
+        self.assertNotEqual(hash64(1), hash64(1.0))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,76 @@
+import asyncio
+import os
+import unittest
+
+
+class AsyncJSONLTest(unittest.TestCase):
+    def test_write_and_stream(self):
+        from bobtools.io import AsyncJSONL
+
+        async def roundtrip(filename, data):
+            async with AsyncJSONL(filename, batch_size=10, max_pending=2) as jsonl:
+                for obj in data[:50]:
+                    await jsonl.append(obj)
+                await jsonl.extend(data[50:])
+                await jsonl.flush()
+                self.assertEqual(jsonl.written, len(data))
+                return [obj async for obj in jsonl]
+
+        for filename in ["test_tmpfile.jsonl", "test_tmpfile.jsonl.gz"]:
+            if os.path.exists(filename):
+                os.remove(filename)
+            data = [{"n": i} for i in range(105)]
+            self.assertEqual(asyncio.run(roundtrip(filename, data)), data)
+            os.remove(filename)
+
+    def test_extend_async_iterable(self):
+        from bobtools.io import AsyncJSONL
+
+        async def generate():
+            for i in range(20):
+                yield i
+
+        async def write_and_read(filename):
+            jsonl = AsyncJSONL(filename, batch_size=3)
+            await jsonl.extend(generate())
+            contents = await jsonl.read()
+            await jsonl.close()
+            return contents
+
+        filename = "test_tmpfile.jsonl"
+        if os.path.exists(filename):
+            os.remove(filename)
+        self.assertEqual(asyncio.run(write_and_read(filename)), list(range(20)))
+        os.remove(filename)
+
+    def test_close_twice(self):
+        from bobtools.io import JSONL, AsyncJSONL
+
+        async def write(filename):
+            async with AsyncJSONL(filename) as jsonl:
+                await jsonl.extend(range(5))
+                await jsonl.close()
+
+        filename = "test_tmpfile.jsonl"
+        if os.path.exists(filename):
+            os.remove(filename)
+        asyncio.run(write(filename))
+        self.assertEqual(JSONL(filename).read(), list(range(5)))
+        os.remove(filename)
+
+    def test_errors_surface_on_flush(self):
+        from bobtools.io import AsyncJSONL
+
+        async def write_unserializable(filename):
+            async with AsyncJSONL(filename, batch_size=1) as jsonl:
+                await jsonl.append(object())
+
+        filename = "test_tmpfile.jsonl"
+        if os.path.exists(filename):
+            os.remove(filename)
+        self.assertRaises(TypeError, asyncio.run, write_unserializable(filename))
+        os.remove(filename)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import unittest
+
+from bobtools.io import backends
+
+
+class BackendsTest(unittest.TestCase):
+    def test_stdlib_always_available(self):
+        self.assertIn("json", backends.available_backends())
+        self.assertEqual(backends.get_backend("json").name, "json")
+
+    def test_default_is_fastest_available(self):
+        self.assertEqual(backends.get_backend().name, backends.available_backends()[0])
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, backends.get_backend, "yaml")
+
+    def test_roundtrip(self):
+        obj = {"a": [1, 2.5, None, True], "b": {"c": "é"}, 1: "int key"}
+        expected = {"a": [1, 2.5, None, True], "b": {"c": "é"}, "1": "int key"}
+        for name in backends.available_backends():
+            backend = backends.get_backend(name)
+            line = backend.dumps(obj)
+            self.assertIsInstance(line, str)
+            self.assertEqual(backend.loads(line), expected)
+            self.assertEqual(backend.loads(line.encode()), expected)
+            if backend.dumpb:
+                self.assertEqual(backend.loads(backend.dumpb(obj)), expected)
+
+    def test_same_data_as_json(self):
+        import math
+
+        from bobtools.io import JSONL
+
+        data = [{"x": 2**70}, float("nan"), {"y": [float("inf"), None]}]
+        for name in backends.available_backends():
+            filename = "test_tmpfile.jsonl"
+            if os.path.exists(filename):
+                os.remove(filename)
+            jsonl = JSONL(filename, json_backend=name, skip_unserializable_objects=True)
+            jsonl.extend(data + [object()])
+            result = jsonl.read()
+            self.assertEqual(jsonl.written, 3)
+            self.assertEqual(result[0], {"x": 2**70})
+            self.assertTrue(math.isnan(result[1]))
+            self.assertEqual(result[2], {"y": [float("inf"), None]})
+            os.remove(filename)
+
+    def test_jsonl_with_backends(self):
+        from bobtools.io import JSONL
+
+        data = ["string", 1, {"a": "b"}, [1, 2], 1.2]
+        for name in backends.available_backends():
+            for filename in ["test_tmpfile.jsonl", "test_tmpfile.jsonl.gz"]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+                jsonl = JSONL(filename, json_backend=name)
+                jsonl.extend(data)
+                self.assertEqual(jsonl.read(), data)
+                self.assertEqual(jsonl[2], data[2])
+                os.remove(filename)
+
+
+if __name__ == "__main__":
+    unittest.main()
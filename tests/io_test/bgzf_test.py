@@ -0,0 +1,57 @@
+import gzip
+import os
+import unittest
+
+
+class BGZFTest(unittest.TestCase):
+    def test_blocks_are_line_aligned(self):
+        from bobtools.io.bgzf import BGZFFile, read_block_index, read_blocks
+
+        filename = "test_tmpfile.bgz"
+        if os.path.exists(filename):
+            os.remove(filename)
+
+        lines = [f"line {i}\n".encode() for i in range(1000)]
+        with BGZFFile(filename, mode="ab", block_size=100) as f:
+            for line in lines:
+                f.write(line)
+
+        with open(filename, "rb") as f:
+            blocks = read_block_index(f)
+            self.assertGreater(len(blocks), 1)
+            self.assertEqual(sum(block.n_lines for block in blocks), len(lines))
+            for block, data in zip(blocks, read_blocks(f, blocks, max_workers=2)):
+                self.assertTrue(data.endswith(b"\n"))
+                self.assertEqual(data.count(b"\n"), block.n_lines)
+                self.assertEqual(
+                    data,
+                    b"".join(
+                        lines[block.first_line : block.first_line + block.n_lines]
+                    ),
+                )
+
+        os.remove(filename)
+
+    def test_readable_as_gzip(self):
+        from bobtools.io.bgzf import BGZFFile
+
+        filename = "test_tmpfile.bgz"
+        if os.path.exists(filename):
+            os.remove(filename)
+
+        data = b"".join(f"line {i}\n".encode() for i in range(1000))
+        with BGZFFile(filename, mode="ab", block_size=256) as f:
+            f.write(data)
+        with BGZFFile(filename, mode="ab", block_size=256) as f:
+            f.write(data)
+
+        with gzip.open(filename, "rb") as f:
+            self.assertEqual(f.read(), data + data)
+        with BGZFFile(filename, mode="rb") as f:
+            self.assertEqual(f.readline(), b"line 0\n")
+
+        os.remove(filename)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,3 +1,4 @@
+import importlib.util
 import os
 import unittest
 import unittest.mock
@@ -127,6 +128,376 @@ class JSONLTest(unittest.TestCase):
         self.assertEqual(jsonl_writer.readline(), data)
         os.remove(filename)
 
+    def test_buffered_extend(self):
+        from bobtools.io import JSONL
+
+        for filename in ["test_tmpfile.jsonl", "test_tmpfile.jsonl.gz"]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+            data = [{"n": i} for i in range(1000)]
+
+            jsonl_writer = JSONL(filename, write_buffer_size=100)
+            jsonl_writer.extend(data[:500])
+            jsonl_writer.append(data[500])
+            jsonl_writer.extend(data[501:])
+            self.assertEqual(jsonl_writer.written, len(data))
+            jsonl_writer.close()
+
+            self.assertEqual(JSONL(filename).read(), data)
+            os.remove(filename)
+
+    def test_flush(self):
+        from bobtools.io import JSONL
+
+        filename = "test_tmpfile.jsonl"
+        if os.path.exists(filename):
+            os.remove(filename)
+
+        jsonl_writer = JSONL(filename)
+        jsonl_writer.extend(["a", "b"])
+        self.assertEqual(os.path.getsize(filename), 0)
+        jsonl_writer.flush()
+        self.assertEqual(os.path.getsize(filename), len('"a"\n"b"\n'))
+        jsonl_writer.close()
+        os.remove(filename)
+
+    def test_close_after_read(self):
+        from bobtools.io import JSONL
+
+        for filename in ["test_tmpfile.jsonl", "test_tmpfile.jsonl.gz"]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+            jsonl = JSONL(filename)
+            jsonl.append(1)
+            self.assertEqual(jsonl.read(), [1])
+            # the read closed the file, closing has to write the buffer anyway
+            jsonl.append(2)
+            jsonl.close()
+
+            self.assertEqual(JSONL(filename).read(), [1, 2])
+            os.remove(filename)
+
+    def test_skip_unserializable_objects(self):
+        from bobtools.io import JSONL
+
+        filename = "test_tmpfile.jsonl"
+        if os.path.exists(filename):
+            os.remove(filename)
+
+        jsonl_writer = JSONL(filename, skip_unserializable_objects=True)
+        jsonl_writer.extend([1, object(), 2])
+        jsonl_writer.append(object())
+        self.assertEqual(jsonl_writer.written, 2)
+        self.assertEqual(jsonl_writer.read(), [1, 2])
+        os.remove(filename)
+
+        jsonl_writer = JSONL(filename)
+        self.assertRaises(TypeError, jsonl_writer.extend, [1, object()])
+        jsonl_writer.close()
+        os.remove(filename)
+
+    def test_truthiness(self):
+        from bobtools.io import JSONL
+
+        filename = "test_tmpfile.jsonl"
+        if os.path.exists(filename):
+            os.remove(filename)
+
+        jsonl = JSONL(filename)
+        self.assertTrue(jsonl)
+        jsonl.extend([1, 2])
+        jsonl.close()
+
+        jsonl = JSONL(filename)
+        self.assertTrue(jsonl)
+        # without building the index
+        self.assertIsNone(jsonl._offsets)
+        self.assertEqual(jsonl.read(), [1, 2])
+        os.remove(filename)
+
+    def test_random_access(self):
+        from bobtools.io import JSONL
+
+        for filename in ["test_tmpfile.jsonl", "test_tmpfile.jsonl.gz"]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+            data = [{"n": i, "text": "é" * (i % 3)} for i in range(100)]
+
+            jsonl = JSONL(filename)
+            jsonl.extend(data)
+            self.assertEqual(len(jsonl), len(data))
+            self.assertEqual(jsonl[0], data[0])
+            self.assertEqual(jsonl[42], data[42])
+            self.assertEqual(jsonl[-1], data[-1])
+            self.assertEqual(jsonl[10:20], data[10:20])
+            self.assertEqual(jsonl[::7], data[::7])
+            self.assertRaises(IndexError, jsonl.__getitem__, 100)
+
+            # index is kept up to date while appending
+            jsonl.append({"n": 100})
+            self.assertEqual(len(jsonl), len(data) + 1)
+            self.assertEqual(jsonl[-1], {"n": 100})
+            jsonl.close()
+            os.remove(filename)
+
+    def test_sidecar_index(self):
+        from bobtools.io import JSONL
+
+        filename = "test_tmpfile.jsonl"
+        for f in [filename, filename + ".idx"]:
+            if os.path.exists(f):
+                os.remove(f)
+
+        jsonl = JSONL(filename, index=True)
+        jsonl.extend(range(10))
+        jsonl.close()
+        self.assertTrue(os.path.exists(filename + ".idx"))
+
+        jsonl = JSONL(filename, index=True)
+        with unittest.mock.patch.object(JSONL, "_build_index") as build_index:
+            self.assertEqual(jsonl[3], 3)
+            self.assertEqual(len(jsonl), 10)
+            build_index.assert_not_called()
+        jsonl.close()
+
+        # a stale sidecar is ignored and rebuilt
+        with open(filename, "a") as f:
+            f.write("10\n")
+        jsonl = JSONL(filename, index=True)
+        self.assertEqual(len(jsonl), 11)
+        jsonl.close()
+
+        os.remove(filename)
+        os.remove(filename + ".idx")
+
+    def test_write_and_random_access_bgzf(self):
+        from bobtools.io import JSONL
+
+        filename = "test_tmpfile.jsonl.bgz"
+        if os.path.exists(filename):
+            os.remove(filename)
+
+        data = [{"n": i, "padding": "x" * 100} for i in range(2000)]
+
+        jsonl = JSONL(filename)
+        jsonl.extend(data)
+        self.assertEqual(len(jsonl), len(data))
+        self.assertEqual(jsonl[1500], data[1500])
+        self.assertEqual(jsonl[-1], data[-1])
+        self.assertEqual(jsonl[100:1900], data[100:1900])
+        self.assertGreater(len(jsonl._blocks), 1)
+        jsonl.append({"n": 2000})
+        self.assertEqual(jsonl[2000], {"n": 2000})
+        jsonl.close()
+
+        self.assertEqual(JSONL(filename).read(), data + [{"n": 2000}])
+        os.remove(filename)
+
+    def test_parallel_stream(self):
+        from bobtools.io import JSONL
+
+        for filename in ["test_tmpfile.jsonl", "test_tmpfile.jsonl.bgz"]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+            data = [{"n": i, "text": "é" * (i % 3)} for i in range(5000)]
+
+            jsonl = JSONL(filename)
+            jsonl.extend(data)
+            jsonl.close()
+
+            jsonl = JSONL(filename)
+            self.assertEqual(list(jsonl.stream(n_workers=2, shard_size=4096)), data)
+            self.assertEqual(jsonl.n_read, len(data))
+
+            jsonl = JSONL(filename)
+            unordered = jsonl.stream(n_workers=2, ordered=False, shard_size=4096)
+            self.assertEqual(sorted(unordered, key=lambda obj: obj["n"]), data)
+            self.assertEqual(jsonl.n_read, len(data))
+            os.remove(filename)
+
+    def test_parallel_stream_skip_unserializable_objects(self):
+        from bobtools.io import JSONL
+
+        filename = "test_tmpfile.jsonl"
+        with open(filename, "w") as f:
+            f.write("1\n{broken\n3\n")
+
+        jsonl = JSONL(filename, skip_unserializable_objects=True)
+        self.assertEqual(list(jsonl.stream(n_workers=2, shard_size=2)), [1, None, 3])
+        jsonl = JSONL(filename)
+        self.assertRaises(ValueError, list, jsonl.stream(n_workers=2, shard_size=2))
+        os.remove(filename)
+
+    def test_mmap_read(self):
+        from bobtools.io import JSONL
+        from bobtools.io.backends import available_backends
+
+        filename = "test_tmpfile.jsonl"
+        if os.path.exists(filename):
+            os.remove(filename)
+
+        data = [{"n": i, "text": "é" * (i % 3)} for i in range(100)]
+        jsonl = JSONL(filename)
+        jsonl.extend(data)
+        jsonl.close()
+
+        for backend in available_backends():
+            jsonl = JSONL(filename, use_mmap=True, json_backend=backend)
+            self.assertEqual(jsonl.read(), data)
+            self.assertEqual(list(jsonl.stream()), data)
+            self.assertEqual(jsonl.n_read, 2 * len(data))
+            stream = jsonl.stream()
+            self.assertEqual(next(stream), data[0])
+            stream.close()
+
+        # chunks smaller than, and not aligned with, the lines
+        with unittest.mock.patch("bobtools.io.jsonl.MMAP_CHUNK_SIZE", 7):
+            self.assertEqual(JSONL(filename, use_mmap=True).read(), data)
+
+        with open(filename, "a") as f:
+            f.write("{broken")
+        jsonl = JSONL(filename, use_mmap=True, skip_unserializable_objects=True)
+        self.assertEqual(jsonl.read(), data + [None])
+        jsonl = JSONL(filename, use_mmap=True)
+        self.assertRaises(ValueError, jsonl.read)
+        os.remove(filename)
+
+    def test_stream_projection_and_filter(self):
+        from bobtools.io import JSONL
+
+        filename = "test_tmpfile.jsonl"
+        if os.path.exists(filename):
+            os.remove(filename)
+
+        data = [
+            {
+                "id": i,
+                "user": {"name": f"user {i}"},
+                "tags": ["even" if i % 2 else "odd"],
+            }
+            for i in range(100)
+        ]
+        jsonl = JSONL(filename)
+        jsonl.extend(data)
+        jsonl.close()
+
+        for n_workers in [None, 2]:
+            for use_mmap in [False, True]:
+                jsonl = JSONL(filename, use_mmap=use_mmap)
+                selected = list(
+                    jsonl.stream(
+                        n_workers=n_workers,
+                        shard_size=256,
+                        fields=["id", "user.name", ("tags", 0), "missing.key"],
+                        where=lambda obj: obj["id"] % 10 == 0,
+                        contains="odd",
+                    )
+                )
+                expected = [
+                    {
+                        "id": i,
+                        "user.name": f"user {i}",
+                        ("tags", 0): "odd",
+                        "missing.key": None,
+                    }
+                    for i in range(0, 100, 10)
+                ]
+                self.assertEqual(selected, expected)
+                self.assertEqual(jsonl.n_read, len(data))
+
+        os.remove(filename)
+
+    def test_iter_batches(self):
+        from bobtools.io import JSONL
+
+        filename = "test_tmpfile.jsonl"
+        if os.path.exists(filename):
+            os.remove(filename)
+
+        jsonl = JSONL(filename)
+        jsonl.extend(range(25))
+        batches = list(jsonl.iter_batches(10))
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        self.assertEqual(sum(batches, []), list(range(25)))
+        os.remove(filename)
+
+    def test_to_arrays_and_dataframe(self):
+        import numpy as np
+
+        from bobtools.datascan import DictScanner
+        from bobtools.io import JSONL
+
+        filename = "test_tmpfile.jsonl"
+        if os.path.exists(filename):
+            os.remove(filename)
+
+        data = [
+            {
+                "id": i,
+                "nested": {"score": i / 2, "name": f"n{i}"},
+                "opt": i or None,
+                "tags": ["t"] * (i % 3),
+            }
+            for i in range(25)
+        ]
+        jsonl = JSONL(filename)
+        jsonl.extend(data)
+        jsonl.close()
+
+        arrays = JSONL(filename).to_arrays(batch_size=10)
+        self.assertEqual(list(arrays), ["id", "nested", "opt", "tags"])
+        self.assertEqual(arrays["id"].dtype, np.int64)
+        self.assertEqual(arrays["nested"][3], data[3]["nested"])
+        # the first batch has a missing value, so falls back to objects
+        self.assertEqual(arrays["opt"].dtype, object)
+
+        schema = DictScanner(data).to_schema()
+        arrays = JSONL(filename).to_arrays(
+            fields=["id", "nested.score", "nested.name", "tags"],
+            schema=schema,
+            batch_size=10,
+        )
+        self.assertEqual(arrays["nested.score"].dtype, np.float64)
+        self.assertEqual(arrays["nested.name"].dtype, object)
+        self.assertEqual(list(arrays["id"]), list(range(25)))
+        self.assertEqual(arrays["tags"].dtype, object)
+        self.assertEqual(arrays["tags"][4], ["t"])
+
+        df = JSONL(filename).to_dataframe(fields=["id", "nested.score"])
+        self.assertEqual(list(df.columns), ["id", "nested.score"])
+        self.assertEqual(len(df), 25)
+        self.assertAlmostEqual(df["nested.score"].sum(), sum(i / 2 for i in range(25)))
+
+        # lines that are not objects are missing values
+        jsonl = JSONL(filename)
+        jsonl.append([1, 2])
+        jsonl.close()
+        arrays = JSONL(filename).to_arrays(batch_size=10)
+        self.assertEqual(len(arrays["id"]), 26)
+        self.assertIsNone(arrays["id"][25])
+        os.remove(filename)
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "requires pyarrow")
+    def test_to_arrow(self):
+        from bobtools.io import JSONL
+
+        filename = "test_tmpfile.jsonl"
+        if os.path.exists(filename):
+            os.remove(filename)
+
+        jsonl = JSONL(filename)
+        jsonl.extend({"id": i, "value": None if i < 10 else i / 2} for i in range(25))
+        jsonl.close()
+
+        table = JSONL(filename).to_arrow(batch_size=10)
+        self.assertEqual(table.num_rows, 25)
+        self.assertEqual(table.column("value").null_count, 10)
+        os.remove(filename)
+
 
 if __name__ == "__main__":
     unittest.main()
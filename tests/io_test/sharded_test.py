@@ -0,0 +1,83 @@
+import os
+import tempfile
+import unittest
+
+
+class ShardedJSONLTest(unittest.TestCase):
+    def test_max_records(self):
+        from bobtools.io import JSONL, ShardedJSONL
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            basename = os.path.join(tmpdir, "out")
+            with ShardedJSONL(basename, max_records=10) as writer:
+                writer.extend(range(25))
+
+            shards = ShardedJSONL.read_manifest(f"{basename}.manifest.json")
+            self.assertEqual([shard["records"] for shard in shards], [10, 10, 5])
+            self.assertEqual(
+                [os.path.basename(shard["filename"]) for shard in shards],
+                ["out-00000.jsonl", "out-00001.jsonl", "out-00002.jsonl"],
+            )
+            contents = []
+            for shard in shards:
+                contents.extend(JSONL(shard["filename"]).read())
+            self.assertEqual(contents, list(range(25)))
+
+    def test_max_bytes_and_compress(self):
+        from bobtools.io import JSONL, ShardedJSONL
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            basename = os.path.join(tmpdir, "out")
+            data = [{"n": i, "padding": "x" * 80} for i in range(100)]
+            writer = ShardedJSONL(basename, max_bytes=1000, compress=True)
+            writer.extend(data)
+            writer.close()
+
+            shards = ShardedJSONL.read_manifest(f"{basename}.manifest.json")
+            self.assertEqual(len(shards), 10)
+            self.assertTrue(all(shard["bytes"] >= 1000 for shard in shards))
+            self.assertEqual(sum(shard["records"] for shard in shards), len(data))
+            self.assertEqual(sorted(os.listdir(tmpdir))[0], "out-00000.jsonl.gz")
+
+            contents = []
+            for shard in shards:
+                self.assertTrue(shard["filename"].endswith(".jsonl.gz"))
+                contents.extend(JSONL(shard["filename"]).read())
+            self.assertEqual(contents, data)
+
+    def test_skip_unserializable(self):
+        from bobtools.io import ShardedJSONL
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            basename = os.path.join(tmpdir, "out")
+            with ShardedJSONL(
+                basename, max_records=2, skip_unserializable_objects=True
+            ) as writer:
+                writer.extend([1, object(), 2, 3, object()])
+            self.assertEqual(writer.written, 3)
+
+            shards = ShardedJSONL.read_manifest(f"{basename}.manifest.json")
+            self.assertEqual([shard["records"] for shard in shards], [2, 1])
+
+    def test_existing_compressed_shards(self):
+        from bobtools.io import ShardedJSONL
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            basename = os.path.join(tmpdir, "out")
+            with ShardedJSONL(basename, max_records=10, compress=True) as writer:
+                writer.extend(range(5))
+
+            writer = ShardedJSONL(basename, max_records=10, compress=True)
+            self.assertRaises(FileExistsError, writer.append, 1)
+            writer.close()
+            shards = ShardedJSONL.read_manifest(f"{basename}.manifest.json")
+            self.assertEqual([shard["records"] for shard in shards], [5])
+
+    def test_requires_limit(self):
+        from bobtools.io import ShardedJSONL
+
+        self.assertRaises(ValueError, ShardedJSONL, "out")
+
+
+if __name__ == "__main__":
+    unittest.main()
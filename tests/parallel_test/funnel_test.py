@@ -1,6 +1,7 @@
+import sys
 import unittest
 
-from bobtools.parallel import funnel
+from bobtools.parallel import Funnel, funnel
 
 
 class funnelTest(unittest.TestCase):
@@ -66,8 +67,8 @@ class funnelTest(unittest.TestCase):
         res = list(funnel(with_named(), parallel_func, single_func))
         expected = [i * 4 / 3 for i in range(10)]
 
-        self.assertEqual(sum(res), sum(expected))
-        self.assertEqual(len(res), len(expected))
+        # results come in any order, and float sums depend on the order
+        self.assertEqual(sorted(res), sorted(expected))
 
     def test_assert_minimum_check(self):
 
@@ -107,6 +108,431 @@ class funnelTest(unittest.TestCase):
         res = list(funnel(datagen(), multi_func, toucher.touch))
         self.assertEqual(res[-1], sum([thing["id"] + 1 for thing in data]))
 
+    def test_chunksize(self):
+        def with_positional():
+            for i in range(100):
+                yield (i, 2)
+
+        multi_func = lambda x, y: {"x": x * y}  # noqa
+        single_func = lambda x: x if x % 4 else None  # noqa
+
+        for chunksize in [1, 7, "auto"]:
+            res = list(
+                funnel(with_positional(), multi_func, single_func, chunksize=chunksize)
+            )
+            expected = [i * 2 for i in range(100) if i * 2 % 4]
+            self.assertEqual(sorted(res), expected)
+
+    def test_adaptive_chunks(self):
+        from bobtools.parallel._funnel import MAX_CHUNKSIZE, TARGET_CHUNK_TIME, _chunks
+
+        class TaskTime:
+            value = 0.0
+
+        task_time = TaskTime()
+        chunks = _chunks(range(100000), 1, task_time)
+        self.assertEqual(len(next(chunks)), 1)
+        task_time.value = TARGET_CHUNK_TIME / 50
+        self.assertEqual(len(next(chunks)), 50)
+        task_time.value = TARGET_CHUNK_TIME / 1e9
+        self.assertEqual(len(next(chunks)), MAX_CHUNKSIZE)
+
+    def test_ordered(self):
+        import random
+        import time
+
+        def multi_func(x):
+            time.sleep(random.random() / 100)
+            return x * 2
+
+        single_func = lambda x: x if x % 3 else None  # noqa
+
+        for chunksize in [1, 4]:
+            res = list(
+                funnel(
+                    range(100),
+                    multi_func,
+                    single_func,
+                    chunksize=chunksize,
+                    ordered=True,
+                    window=3,
+                )
+            )
+            self.assertEqual(res, [i * 2 for i in range(100) if i * 2 % 3])
+
+        res = list(funnel(range(100), multi_func, ordered=True))
+        self.assertEqual(res, [i * 2 for i in range(100)])
+
+    def test_timeout(self):
+        import time
+
+        def slow_func(x):
+            time.sleep(5)
+            return x
+
+        with self.assertRaises(TimeoutError):
+            list(funnel(range(3), slow_func, timeout=0.5))
+
+    def test_failing_worker(self):
+        def failing_func(x):
+            raise ValueError("broken task")
+
+        with self.assertRaises(ValueError):
+            list(funnel(range(3), failing_func, timeout=10))
+
+    def test_backends(self):
+        import threading
+
+        lock = threading.Lock()  # can't be pickled, fine for threads
+
+        def multi_func(x, y):
+            with lock:
+                return {"x": x * y}
+
+        single_func = lambda x: x if x % 4 else None  # noqa
+        expected = [i * 2 for i in range(100) if i * 2 % 4]
+
+        for backend in ["thread", "asyncio"]:
+            for chunksize in [1, 7]:
+                res = funnel(
+                    ((i, 2) for i in range(100)),
+                    multi_func,
+                    single_func,
+                    chunksize=chunksize,
+                    backend=backend,
+                )
+                self.assertEqual(sorted(res), expected)
+
+    def test_asyncio_coroutines(self):
+        import asyncio
+
+        running = []
+        max_running = []
+
+        async def multi_func(x):
+            running.append(x)
+            max_running.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(x)
+            return x * 2
+
+        res = list(
+            funnel(range(50), multi_func, n_workers=11, backend="asyncio", ordered=True)
+        )
+        self.assertEqual(res, [i * 2 for i in range(50)])
+        self.assertLessEqual(max(max_running), 10)
+        self.assertGreater(max(max_running), 1)
+
+    def test_failing_thread_worker(self):
+        def failing_func(x):
+            raise ValueError("broken task")
+
+        for backend in ["thread", "asyncio"]:
+            with self.assertRaises(ValueError):
+                list(funnel(range(3), failing_func, timeout=10, backend=backend))
+
+    def test_retries(self):
+        import threading
+
+        attempts = {}
+        lock = threading.Lock()
+
+        def flaky_func(x):
+            with lock:
+                attempts[x] = attempts.get(x, 0) + 1
+                if attempts[x] < 3:
+                    raise ConnectionError("try again")
+            return x * 2
+
+        for backend in ["thread", "asyncio"]:
+            attempts.clear()
+            res = funnel(range(10), flaky_func, retries=2, backend=backend)
+            self.assertEqual(sorted(res), [i * 2 for i in range(10)])
+
+        attempts.clear()
+        with self.assertRaises(ConnectionError):
+            list(funnel(range(10), flaky_func, retries=1, backend="thread"))
+
+    def test_dead_letter(self):
+        def multi_func(x):
+            if x % 10 == 3:
+                raise ValueError(x)
+            return x
+
+        def single_func(x):
+            if x % 10 == 5:
+                raise KeyError(x)
+            return x
+
+        failed = []
+        res = funnel(
+            range(50),
+            multi_func,
+            single_func,
+            chunksize=4,
+            dead_letter=lambda task, error: failed.append((task, type(error))),
+        )
+        self.assertEqual(sorted(res), [i for i in range(50) if i % 10 not in (3, 5)])
+        self.assertEqual(
+            sorted(failed, key=lambda failure: failure[0]),
+            sorted(
+                [(i, ValueError) for i in range(3, 50, 10)]
+                + [(i, KeyError) for i in range(5, 50, 10)]
+            ),
+        )
+
+    def test_task_timeout(self):
+        import time
+
+        def multi_func(x):
+            if x == 7:
+                time.sleep(60)
+            return x
+
+        failed = []
+        res = funnel(
+            range(20),
+            multi_func,
+            chunksize=3,
+            task_timeout=0.5,
+            dead_letter=lambda task, error: failed.append((task, type(error))),
+            timeout=30,
+        )
+        self.assertEqual(sorted(res), [i for i in range(20) if i != 7])
+        self.assertEqual(failed, [(7, TimeoutError)])
+
+        with self.assertRaises(TimeoutError):
+            list(funnel(range(20), multi_func, task_timeout=0.5, timeout=30))
+
+    def test_crashing_worker(self):
+        import os
+
+        def multi_func(x):
+            if x == 11:
+                os._exit(1)
+            return x
+
+        failed = []
+        res = funnel(
+            range(30),
+            multi_func,
+            lambda x: x,
+            chunksize=4,
+            ordered=True,
+            dead_letter=lambda task, error: failed.append(task),
+            timeout=30,
+        )
+        self.assertEqual(list(res), [i for i in range(30) if i != 11])
+        self.assertEqual(failed, [11])
+
+    def test_crash_calls_single_func_once(self):
+        import os
+        import tempfile
+        import time
+
+        def multi_func(x):
+            if x == 23:
+                os._exit(1)
+            return x
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "calls.txt")
+
+            def single_func(x):
+                with open(filename, "a") as f:
+                    f.write(f"{x}\n")
+                return x
+
+            res = []
+            for result in funnel(
+                range(60),
+                multi_func,
+                single_func,
+                dead_letter=lambda task, error: None,
+                timeout=30,
+            ):
+                # a slow consumer keeps chunks in flight when the worker dies
+                time.sleep(0.01)
+                res.append(result)
+            with open(filename) as f:
+                calls = [int(line) for line in f]
+
+        expected = [i for i in range(60) if i != 23]
+        self.assertEqual(sorted(res), expected)
+        self.assertEqual(sorted(calls), expected)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            Funnel(backend="fork")
+
+
+class FunnelPoolTest(unittest.TestCase):
+    def test_reuse_workers(self):
+        with Funnel(n_workers=3) as pool:
+            res = list(pool.run(range(10), lambda x: x * 2))
+            self.assertEqual(sorted(res), [i * 2 for i in range(10)])
+            pids = [w.process.pid for w in pool._multi_workers]
+
+            # new functions are shipped to the same workers
+            res = list(pool.run(range(10), lambda x: x + 1, lambda x: x * 10))
+            self.assertEqual(sorted(res), [(i + 1) * 10 for i in range(10)])
+            res = list(pool.run(range(10), lambda x: x + 1, ordered=True))
+            self.assertEqual(res, [i + 1 for i in range(10)])
+            self.assertEqual(list(pool.run([], lambda x: x)), [])
+            self.assertEqual([w.process.pid for w in pool._multi_workers], pids)
+        self.assertFalse(pool.started)
+
+    def test_unfinished_run(self):
+        with Funnel(n_workers=2) as pool:
+            results = pool.run(range(1000), lambda x: x)
+            next(results)
+            with self.assertRaises(RuntimeError):
+                next(pool.run(range(10), lambda x: x))
+            results.close()
+            self.assertFalse(pool.started)
+
+            # the next run starts fresh workers
+            res = list(pool.run(range(10), lambda x: x, ordered=True))
+            self.assertEqual(res, list(range(10)))
+
+    def test_stale_chunks(self):
+        calls = []
+
+        def first_func(x):
+            calls.append(x)
+            return x
+
+        with Funnel(n_workers=2, backend="thread") as pool:
+            list(pool.run(range(3), first_func))
+            list(pool.run(range(3), lambda x: -x))
+            # a chunk of the first run, resubmitted after a crash, left behind
+            pool._multi_func_queue.put((1, 1, 0, [10]))
+            res = list(pool.run(range(3), lambda x: x + 1, lambda x: x, timeout=5))
+        self.assertEqual(sorted(res), [1, 2, 3])
+        self.assertEqual(calls, [0, 1, 2])
+
+    def test_scaling(self):
+        import threading
+        import time
+
+        names = set()
+
+        def slow_func(x):
+            names.add(threading.current_thread().name)
+            time.sleep(0.01)
+            return x
+
+        with Funnel(n_workers=(2, 4), backend="thread") as pool:
+            res = list(pool.run(range(300), slow_func, lambda x: x))
+            self.assertEqual(sorted(res), list(range(300)))
+            # tasks piled up, so workers were added up to the maximum
+            self.assertGreater(len(names), 1)
+            self.assertLessEqual(len(pool._multi_workers), 3)
+
+    def test_passthrough_in_parent(self):
+        with Funnel(n_workers=2) as pool:
+            res = list(pool.run(range(10), lambda x: x, ordered=True))
+            self.assertEqual(res, list(range(10)))
+            self.assertIsNone(pool._single_worker)
+
+            res = list(pool.run(range(10), lambda x: x, lambda x: -x, ordered=True))
+            self.assertEqual(res, [-x for x in range(10)])
+            self.assertIsNotNone(pool._single_worker)
+
+            # the single-worker leaves pass-through runs alone
+            res = list(pool.run(range(10), lambda x: x + 1))
+            self.assertEqual(sorted(res), list(range(1, 11)))
+
+    @unittest.skipIf(sys.version_info < (3, 8), "shared memory needs Python 3.8")
+    def test_shared_memory(self):
+        import numpy as np
+
+        def multi_func(i):
+            return np.full((200, 100), i, dtype="int64"), bytes([i]) * 20000
+
+        def single_func(array, data):
+            return {"sum": array.sum(), "array": array, "data": data}
+
+        with Funnel(
+            shared_memory=True, shm_threshold=10000, shm_block_size=200000, shm_blocks=3
+        ) as pool:
+            # more results in flight than blocks, the rest is pickled
+            res = pool.run(range(20), multi_func, single_func, ordered=True)
+            for i, result in enumerate(res):
+                self.assertEqual(result["sum"], i * 20000)
+                self.assertEqual(result["array"].shape, (200, 100))
+                self.assertEqual(result["data"], bytes([i]) * 20000)
+
+            # passed through without a single_func
+            res = list(pool.run(range(5), multi_func, ordered=True))
+            for i, (array, data) in enumerate(res):
+                self.assertTrue((array == i).all())
+                self.assertEqual(data, bytes([i]) * 20000)
+
+    @unittest.skipIf(sys.version_info < (3, 8), "shared memory needs Python 3.8")
+    def test_shared_memory_of_dropped_chunks(self):
+        import time
+
+        def multi_func(i):
+            return bytes([i]) * 20000
+
+        with Funnel(
+            shared_memory=True, shm_threshold=10000, shm_block_size=30000, shm_blocks=3
+        ) as pool:
+            list(pool.run(range(5), multi_func, len))
+            list(pool.run(range(5), multi_func, len, ordered=True))
+            # a chunk of a run that is over and a chunk that arrives twice, as
+            # resubmitted chunks do, are dropped by the single-worker
+            for run_id in [1, 2]:
+                handle = pool._shm.encode(bytes(20000))
+                pool._single_func_queue.put((run_id, 0, [handle]))
+            deadline = time.monotonic() + 5
+            while pool._shm.free.qsize() < 3 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(pool._shm.free.qsize(), 3)
+
+    def test_metrics(self):
+        import time
+
+        def multi_func(x):
+            time.sleep(0.002)
+            return x
+
+        snapshots = []
+        with Funnel(
+            backend="thread", on_metrics=snapshots.append, metrics_interval=0
+        ) as pool:
+            self.assertIsNone(pool.metrics())
+            res = list(pool.run(range(20), multi_func, lambda x: x, chunksize=2))
+            self.assertEqual(len(res), 20)
+            metrics = pool.metrics()
+
+        self.assertTrue(snapshots)
+        self.assertEqual(metrics["stages"]["multi"]["tasks"], 20)
+        self.assertEqual(metrics["stages"]["multi"]["chunks"], 10)
+        self.assertEqual(metrics["stages"]["single"]["tasks"], 20)
+        self.assertEqual(
+            set(metrics["workers"]), {"MultiWorker-1", "MultiWorker-2", "SingleWorker"}
+        )
+        multi = metrics["stages"]["multi"]
+        self.assertGreaterEqual(multi["busy"], 20 * 0.002)
+        # every sleep of 2ms lands in the 1-10ms bucket, or later on a busy machine
+        self.assertEqual(sum(multi["latency"][3:]), 20)
+        self.assertEqual(set(metrics["queues"]), {"tasks", "results", "output"})
+        self.assertGreater(metrics["input"]["busy"], 0)
+
+    def test_idle_workers_do_not_report(self):
+        import time
+
+        with Funnel(backend="thread", metrics_interval=0) as pool:
+            list(pool.run(range(20), lambda x: x, lambda x: x))
+            # the last totals of every worker arrive once they are idle
+            time.sleep(0.5)
+            pool.metrics()
+            # after that, polling for work sends nothing
+            time.sleep(0.5)
+            self.assertTrue(pool._metrics_queue.empty())
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+from bobtools.parallel import Pipeline, funnel
+
+
+def parse(line):
+    key, value = line.split("=")
+    return {"key": key, "value": int(value)}
+
+
+def enrich(key, value):
+    return key, value * 10
+
+
+class Dedupe:
+    def __init__(self):
+        self.seen = set()
+
+    def __call__(self, key, value):
+        if key in self.seen:
+            return None
+        self.seen.add(key)
+        return key, value
+
+
+class PipelineTest(unittest.TestCase):
+    def test_stages(self):
+        lines = [f"{i % 10}={i}" for i in range(100)]
+        pipeline = (
+            Pipeline()
+            .stage(parse, n_workers=2)
+            .stage(enrich, n_workers=2, queue_size=5)
+            .stage(Dedupe())
+            .stage(lambda key, value: value, name="value")
+        )
+        self.assertEqual(
+            repr(pipeline), "<Pipeline parse(2) -> enrich(2) -> Dedupe(1) -> value(1)>"
+        )
+
+        for chunksize in [1, 7]:
+            res = list(pipeline.run(lines, chunksize=chunksize))
+            # one value for each of the 10 keys survives deduplication
+            self.assertEqual(len(res), 10)
+            self.assertEqual(sorted(value // 10 % 10 for value in res), list(range(10)))
+
+    def test_funnel_as_pipeline(self):
+        multi_func = lambda x, y: {"x": x * y}  # noqa
+        single_func = lambda x: x if x % 4 else None  # noqa
+        data = [(i, 2) for i in range(100)]
+
+        pipeline = Pipeline().stage(multi_func, n_workers=2).stage(single_func)
+        self.assertEqual(
+            sorted(pipeline.run(data)),
+            sorted(funnel(data, multi_func, single_func, n_workers=3)),
+        )
+
+    def test_threads(self):
+        import threading
+
+        lock = threading.Lock()
+
+        def locked(x):
+            with lock:
+                return x + 1
+
+        pipeline = Pipeline(backend="thread").stage(locked, n_workers=4).stage(None)
+        self.assertEqual(sorted(pipeline.run(range(50))), list(range(1, 51)))
+
+    def test_failing_stage(self):
+        def failing(x):
+            raise ValueError("broken task")
+
+        pipeline = Pipeline().stage(abs).stage(failing, n_workers=2)
+        with self.assertRaises(RuntimeError):
+            list(pipeline.run(range(10), timeout=10))
+
+    def test_no_stages(self):
+        with self.assertRaises(ValueError):
+            next(Pipeline().run(range(10)))
+        with self.assertRaises(ValueError):
+            Pipeline().stage(abs, n_workers=0)
+
+
+if __name__ == "__main__":
+    unittest.main()